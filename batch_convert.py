@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Converts every file of a directory or glob in one process, with the models loaded once for all of them, e.g.:
+#   python batch_convert.py books/ --out-dir audio --workers 2
+#   python batch_convert.py "books/**/*.txt" --lang zh
+# outputs that are newer than their input and were completed are skipped, unless --force is given
+import argparse
+import glob
+import os
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from converter import Converter, load_models
+from manifest import JobManifest
+from model_pool import ModelPool
+
+
+def input_files(pattern):
+    if os.path.isdir(pattern):
+        return sorted(entry.path for entry in os.scandir(pattern) if entry.is_file() and not entry.name.startswith("."))
+    return sorted(file for file in glob.glob(pattern, recursive=True) if os.path.isfile(file))
+
+
+def up_to_date(file, out_dir, out_name):
+    # a completed job with an output newer than the input
+    try:
+        if os.path.getmtime(f"{out_dir}/{out_name}.wav") < os.path.getmtime(file): return False
+    except OSError:
+        return False
+    return JobManifest(f"{out_dir}/{out_name}.manifest").read()[2]
+
+
+def convert_file(converters, file, out_dir, out_name):
+    # runs on whichever converter is idle, each converter does one job at a time
+    converter = converters.get()
+    try:
+        converter.out_dir, converter.out_name = out_dir, out_name
+        start = time.time()
+        converter.set_text_from_file(file)
+        if not converter.txt or converter.txt.isspace():
+            return {"chars": 0, "error": "no text"}
+        converter.convert(background=False)
+        stats = converter.job_stats
+        result = {"chars": len(converter.txt), "audio_seconds": stats.get("audio_seconds", 0),
+                  "wall_seconds": time.time() - start}
+        if "error" in stats: result["error"] = stats["error"]  # can be empty for an exception without a message
+        return result
+    finally:
+        converters.put(converter)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a directory of documents to speech")
+    parser.add_argument("input", help="directory or glob of input files")
+    parser.add_argument("--out-dir", help="where the outputs go, next to each input by default")
+    parser.add_argument("--lang", help="language of all inputs, detected per file by default")
+    parser.add_argument("--workers", type=int, default=1, help="files converted at the same time")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--force", action="store_true", help="convert files whose output is up to date too")
+    parser.add_argument("--verbose", action="store_true", help="print the converter logs")
+    args = parser.parse_args()
+
+    jobs = []
+    for file in input_files(args.input):
+        out_dir = args.out_dir or os.path.dirname(file) or "."
+        jobs.append((file, out_dir, os.path.splitext(os.path.basename(file))[0]))
+    outputs = [(out_dir, out_name) for _, out_dir, out_name in jobs]
+    duplicates = {output for output in outputs if outputs.count(output) > 1}
+    if duplicates:
+        parser.error("several inputs would be written to " + ", ".join(f"{d}/{n}.wav" for d, n in sorted(duplicates)))
+    if args.out_dir: os.makedirs(args.out_dir, exist_ok=True)
+    skipped = [file for file, out_dir, out_name in jobs if not args.force and up_to_date(file, out_dir, out_name)]
+    jobs = [job for job in jobs if job[0] not in skipped]
+    print(f"{len(jobs)} files to convert, {len(skipped)} up to date")
+    if not jobs: return True
+
+    workers = max(1, min(args.workers, len(jobs)))
+    if workers > 1:
+        import torch
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))  # intra-op threads are split between the files
+    pool = ModelPool(load_models, 2048 * 2 ** 20)
+    converters = queue.Queue()
+    for _ in range(workers):
+        converter = Converter(lang=args.lang or "zh", background=False, model_pool=pool, publish=False, print_log=args.verbose)
+        converter.autoDetectLang = not args.lang
+        converter.batch_size = max(1, args.batch_size)
+        converters.put(converter)
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {file: executor.submit(convert_file, converters, file, out_dir, out_name) for file, out_dir, out_name in jobs}
+        results = {}
+        for file, future in futures.items():
+            try:
+                results[file] = future.result()
+            except Exception as e:
+                results[file] = {"chars": 0, "error": str(e) or type(e).__name__}
+            result = results[file]
+            if "error" in result:
+                print(f"{file}: failed ({result['error']})")
+            else:
+                print(f"{file}: {result['chars']} chars, {result['audio_seconds']:.1f}s audio in {result['wall_seconds']:.1f}s, "
+                      f"{result['audio_seconds'] / result['wall_seconds']:.3f} audio seconds per second")
+    wall = time.time() - start
+    audio = sum(result.get("audio_seconds", 0) for result in results.values())
+    failed = sum("error" in result for result in results.values())
+    print(f"Converted {len(results) - failed} files ({failed} failed, {len(skipped)} skipped): "
+          f"{audio:.1f}s audio in {wall:.1f}s, {audio / wall:.3f} audio seconds per second with {workers} worker(s)")
+    return not failed
+
+
+if __name__ == '__main__':
+    exit(0 if main() else 1)
@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+# Benchmarks for the converter, e.g.:
+#   python benchmark.py batch demo_txt_files/cn.txt --sizes 1 2 4 8
+#   python benchmark.py vocoder-swap demo_txt_files/cn.txt --vocoders parallel_wavegan multi_band_melgan
+#   python benchmark.py memory demo_txt_files/cn.txt demo_txt_files/cn2.txt --chunks 0 500 1000
+#   python benchmark.py segments demo_txt_files/cn.txt --targets 0 20 40 80
+#   python benchmark.py shards demo_txt_files/test.txt --lang en --workers 1 2 4 8
+#   python benchmark.py normalize demo_txt_files/cn.txt demo_txt_files/cn2.txt
+#   python benchmark.py numbers
+#   python benchmark.py suite --stub --out before.json, then after a change: python benchmark.py suite --stub --compare before.json
+#   python benchmark.py service demo_txt_files/cn_short.txt --stub --clients 1 8 32
+#   python benchmark.py compiled demo_txt_files/cn.txt --cpu --threads 4 1
+#   python benchmark.py quantized demo_txt_files/cn.txt --max-distance 1.5
+# RTF (real time factor) is always synthesis seconds per audio second, lower is faster.
+# throughput is audio seconds per synthesis second, higher is faster
+import argparse
+import glob
+import json
+import os
+import re
+import tempfile
+import time
+
+from converter import Converter, load_models
+from util import peak_rss, preprocess_cn_text, cn_sent_tokenize, replace_with_cn_num
+
+
+def read_text(file):
+    with open(file, encoding="utf-8", mode="r") as f:
+        return f.read()
+
+
+def run_job(converter, txt):
+    converter.out_dir = tempfile.mkdtemp()
+    converter.set_text(txt)
+    start = time.time()
+    converter.convert(background=False)
+    return dict(converter.job_stats, wall_seconds=time.time() - start)
+
+
+def bench_batch(converter, txt, sizes):
+    run_job(converter, txt[:200])  # warm up
+    results = []
+    for size in sizes:
+        converter.batch_size = size
+        stats = run_job(converter, txt)
+        throughput = stats.get("audio_seconds", 0) / stats["synthesis_seconds"]
+        results.append((size, throughput))
+        print(f"batch size {size:3}: {throughput:.3f} audio seconds per second "
+              f"({stats.get('audio_seconds', 0):.1f}s audio in {stats['synthesis_seconds']:.1f}s)")
+    return results
+
+
+def bench_shards(converter, txt, workers, threads):
+    run_job(converter, txt[:200])  # warm up
+    results = []
+    for n in workers:
+        converter.num_workers = n
+        converter.threads_per_worker = threads
+        run_job(converter, txt[:200])  # start the worker processes outside of the measurement
+        stats = run_job(converter, txt)
+        throughput = stats.get("audio_seconds", 0) / stats["synthesis_seconds"]
+        results.append((n, throughput))
+        print(f"{n:3} workers: {throughput:.3f} audio seconds per second, "
+              f"{throughput / results[0][1]:.2f}x of {results[0][0]} worker(s)")
+    return results
+
+
+def bench_vocoder_swap(converter, txt, vocoders):
+    # first vocoder fills the mel cache, the following ones should only pay for vocoding
+    converter.audio_cache_size = 0
+    results = []
+    for use_mel_cache in (False, True):
+        converter.mel_cache_size = 1024 if use_mel_cache else 0
+        converter.set_custom_model(vocoder_tag=vocoders[0])
+        run_job(converter, txt)
+        for vocoder in vocoders[1:]:
+            converter.set_custom_model(vocoder_tag=vocoder)
+            run_job(converter, txt[:200])  # load the vocoder outside of the measurement
+            stats = run_job(converter, txt)
+            results.append((vocoder, use_mel_cache, stats["synthesis_seconds"]))
+            print(f"{vocoder} {'with' if use_mel_cache else 'without'} mel cache: {stats['synthesis_seconds']:.2f}s "
+                  f"(acoustic model {stats.get('acoustic_seconds', 0):.2f}s)")
+    return results
+
+
+def _memory_run(file, lang, chunk_frames, results):
+    converter = Converter(lang=lang, background=False)
+    converter.autoDetectLang = False
+    converter.audio_cache_size = converter.mel_cache_size = 0
+    converter.vocoder_chunk_frames = chunk_frames
+    before = peak_rss()
+    stats = run_job(converter, read_text(file))
+    results.put((before, stats.get("peak_rss")))
+
+
+def bench_memory(files, lang, chunks):
+    # peak RSS only ever grows, so every run gets a fresh process
+    import multiprocessing
+    ctx = multiprocessing.get_context("spawn")
+    for file in files:
+        for chunk_frames in chunks:
+            results = ctx.Queue()
+            p = ctx.Process(target=_memory_run, args=(file, lang, chunk_frames, results))
+            p.start()
+            before, after = results.get()
+            p.join()
+            print(f"{file} (vocoder chunk {chunk_frames or 'off'}): peak RSS {before / 2 ** 20:.0f}MB after model load, "
+                  f"{after / 2 ** 20:.0f}MB after conversion")
+
+
+def bench_segments(converter, txt, targets):
+    run_job(converter, txt[:200])  # warm up
+    converter.audio_cache_size = converter.mel_cache_size = 0
+    results = []
+    for target in targets:
+        converter.segment_target = target
+        stats = run_job(converter, txt)
+        rtf = stats["synthesis_seconds"] / stats.get("audio_seconds", 1)
+        results.append((target, rtf))
+        print(f"segment target {target or 'off':>4}: RTF {rtf:.3f} ({stats['synthesis_seconds']:.2f}s)")
+    return results
+
+
+def reference_preprocess_cn_text(s):
+    # the multi-pass normalization preprocess_cn_text replaced, its output is the golden reference
+    s = re.sub(r"[+-]?\d+\.?\d*%", lambda m: "百分之" + m.group(0)[:-1], s)
+
+    def replace_units(match):
+        unit = {"m": "米", "v": "伏", "s": "秒", "h": "小时", "g": "克", "w": "瓦", "a": "安", "pa": "帕"}.get(match.group(2).lower())
+        return match.group(1) + unit if unit else match.group(0)
+
+    s = re.sub(r"([+-]?\d+\.?\d*)([a-z]{1,4})", replace_units, s, flags=re.IGNORECASE)
+    for abbr, unit in [("kpa", "千帕"), ("kg", "千克"), ("km", "千米"), ("kw", "千瓦"), ("kv", "千伏"), ("cm", "厘米"), ("mm", "毫米"),
+                       ("mg", "毫克"), ("ma", "毫安"), ("mah", "毫安时"), ("kwh", "千瓦时"), ("mmhg", "毫米汞柱")]:
+        s = re.sub(abbr, unit, s, flags=re.IGNORECASE)
+    s = re.sub(r"¥[+-]?\d+\.?\d*", lambda m: m.group(0)[1:] + "元", s, flags=re.IGNORECASE)
+    for old, new in [("℃", "摄氏度"), ("¥", "元"), ("、", "，"), ("：", "，"), ("；", "，"), ("．", "，"), ("“", ""), ("”", ""),
+                     ("‘", ""), ("’", ""), ("（", "，"), ("）", "，"), ("(", "，"), (")", "，"), ("＞", "大于"), ("＜", "小于"), ("~", "至")]:
+        s = s.replace(old, new)
+    return s
+
+
+def bench_normalize(files, repeat):
+    # per sentence, like the converter calls it. False if any sentence differs from the reference
+    failed = False
+    for file in files:
+        sentences = cn_sent_tokenize(re.sub("\\s+", "", read_text(file)))
+        chars = sum(len(t) for t in sentences) * repeat
+        mismatches = [t for t in sentences if preprocess_cn_text(t) != reference_preprocess_cn_text(t)]
+        for t in mismatches[:5]: print(f"MISMATCH: {t!r}")
+        failed = failed or bool(mismatches)
+        speeds = []
+        for fn in (reference_preprocess_cn_text, preprocess_cn_text):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for t in sentences: fn(t)
+            speeds.append(chars / (time.perf_counter() - start))
+        print(f"{file}: {len(sentences)} sentences, {len(mismatches)} mismatches, "
+              f"{speeds[0]:,.0f} -> {speeds[1]:,.0f} chars/s ({speeds[1] / speeds[0]:.1f}x)")
+    return not failed
+
+
+NUMBER_CASES = [
+    ("共有12345人", "共有一万二千三百四十五人"),
+    ("10014", "一万零十四"),
+    ("3.14", "三点一四"),
+    ("-5度", "负五度"),
+    ("2个人", "两个人"),
+    ("12个人", "十二个人"),
+    ("第2个", "第二个"),
+    ("第2次", "第二次"),
+    ("获得第2名", "获得第二名"),
+    ("2021年3月15日", "二零二一年三月十五日"),
+    ("2021-03-15", "二零二一年三月十五日"),
+    ("2021/3/5", "二零二一年三月五日"),
+    ("1998至2000年", "一九九八至二零零零年"),
+    ("2021年的春天", "二零二一年的春天"),
+    ("中国有5000年的历史", "中国有五千年的历史"),
+    ("距今3000年前", "距今三千年前"),
+    ("2000年代", "二千年代"),
+    ("1000年左右", "一千年左右"),
+    ("3-5天", "三至五天"),
+    ("1.5～2.5米", "一点五至二点五米"),
+    ("12.5％", "百分之十二点五"),
+    ("3‰", "千分之三"),
+    ("拨打13812345678", "拨打幺三八幺二三四五六七八"),
+    ("电话010-12345678", "电话零幺零，幺二三四五六七八"),
+    ("身份证11010519491231002X", "身份证幺幺零幺零五幺九四九幺二三幺零零二X"),
+    ("007", "零零七"),
+]
+
+
+def reference_replace_with_cn_num(s):
+    # every number read as a cardinal with num2chinese, what replace_with_cn_num did before
+    from num2chinese import num2chinese
+    return re.sub(r"[+-]?\d+\.?[\d]*", lambda m: num2chinese(m.group(0)), s)
+
+
+def bench_numbers(repeat):
+    import random
+    from num2chinese import num2chinese
+    from cn_numbers import cardinal
+    failures = [(s, replace_with_cn_num(s), expected) for s, expected in NUMBER_CASES if replace_with_cn_num(s) != expected]
+    for s, got, expected in failures: print(f"FAIL: {s} -> {got}, expected {expected}")
+    # plain numbers still have to read exactly like num2chinese
+    rng = random.Random(0)
+    numbers = [str(n) for n in range(100000)] + [rng.choice(["", "-"]) + str(rng.randrange(10 ** rng.randint(1, 40)))
+                                               + rng.choice(["", f".{rng.randrange(1000)}"]) for _ in range(100000)]
+    mismatches = [n for n in numbers if cardinal(n) != num2chinese(n)]
+    for n in mismatches[:5]: print(f"CARDINAL MISMATCH: {n} -> {cardinal(n)}, num2chinese {num2chinese(n)}")
+    print(f"{len(NUMBER_CASES) - len(failures)}/{len(NUMBER_CASES)} cases, {len(numbers) - len(mismatches)}/{len(numbers)} cardinals correct")
+
+    text = [f"{rng.randint(1900, 2030)}年{rng.randint(1, 12)}月{rng.randint(1, 28)}日收入{rng.randint(0, 10 ** 6)}元，"
+            f"增长{rng.randint(0, 99)}.{rng.randint(0, 9)}%，共{rng.randint(1, 500)}人，电话138{rng.randrange(10 ** 8):08}。"
+            for _ in range(1000)]
+    chars = sum(len(t) for t in text) * repeat
+    speeds = []
+    for fn in (reference_replace_with_cn_num, replace_with_cn_num):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for t in text: fn(t)
+        speeds.append(chars / (time.perf_counter() - start))
+    print(f"number heavy text: {speeds[0]:,.0f} -> {speeds[1]:,.0f} chars/s ({speeds[1] / speeds[0]:.1f}x)")
+    return not failures and not mismatches
+
+
+STAGES = ["read", "preprocess", "detect", "segment", "normalize", "acoustic", "vocoder", "write", "subtitles"]
+
+
+def suite_run(converter, file):
+    # one headless job on a file, the file read is timed here since it happens before the job starts
+    converter.out_dir = tempfile.mkdtemp()
+    start = time.perf_counter()
+    converter.set_text_from_file(file)
+    read = time.perf_counter() - start
+    start = time.perf_counter()
+    converter.convert(background=False)
+    wall = time.perf_counter() - start + read
+    stats = converter.job_stats
+    audio = stats.get("audio_seconds", 0)
+    return {"chars": len(converter.txt),
+            "stages": dict({stage: stats.get(stage + "_seconds", 0) for stage in STAGES}, read=read),
+            "audio_seconds": audio,
+            "wall_seconds": wall,
+            "rtf": wall / audio if audio else None,
+            "peak_rss": stats.get("peak_rss")}
+
+
+def bench_suite(files, lang, loader, out, compare):
+    converter = Converter(lang=lang or "zh", background=False, loader=loader, publish=False)
+    converter.autoDetectLang = not lang
+    converter.audio_cache_size = converter.mel_cache_size = 0  # every run has to do all the work
+    converter.set_text("预热。" * 20)
+    converter.out_dir = tempfile.mkdtemp()
+    converter.convert(background=False)  # loads the models outside of the measurement
+    results = {file: suite_run(converter, file) for file in files}
+    for file, result in results.items():
+        stages = ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in result["stages"].items())
+        rtf = f"{result['rtf']:.3f}" if result["rtf"] is not None else "n/a"
+        print(f"{file} ({result['chars']} chars): RTF {rtf}, {result['wall_seconds']:.2f}s wall, "
+              f"peak RSS {(result['peak_rss'] or 0) / 2 ** 20:.0f}MB\n  {stages}")
+    if out:
+        with open(out, encoding="utf-8", mode="w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if compare:
+        with open(compare, encoding="utf-8", mode="r") as f:
+            baseline = json.load(f)
+        for file, result in results.items():
+            if file not in baseline: continue
+            old = baseline[file]
+            changes = [f"{stage} {result['stages'][stage] / old['stages'][stage]:.2f}x"
+                       for stage in STAGES if old["stages"].get(stage) and result["stages"].get(stage)]
+            print(f"{file} vs {compare}: wall {result['wall_seconds'] / old['wall_seconds']:.2f}x, " + ", ".join(changes))
+    return results
+
+
+async def service_request(port, text):
+    # one POST /synthesize, returns (status line, seconds to the first audio after the header, seconds in total, bytes)
+    import asyncio
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    body = text.encode("utf-8")
+    writer.write(f"POST /synthesize HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    status = (await reader.readline()).decode().strip()
+    first, size = None, 0
+    while True:
+        chunk = await reader.read(1 << 16)
+        if not chunk: break
+        size += len(chunk)
+        if first is None and size > 200: first = time.perf_counter() - start  # past the headers and the WAV header
+    writer.close()
+    return status, first, time.perf_counter() - start, size
+
+
+def bench_service(txt, clients, loader, max_batch, window_ms):
+    # the service on localhost with concurrent clients, each sending the text once
+    import asyncio
+    from service import create_service, percentile
+    service = create_service(loader=loader, max_batch=max_batch, window=window_ms / 1000, max_requests=max(clients))
+
+    async def run():
+        server = await service.start(port=0)
+        port = server.sockets[0].getsockname()[1]
+        await service_request(port, txt[:50])  # warm up
+        for n in clients:
+            start = time.perf_counter()
+            results = await asyncio.gather(*[service_request(port, txt) for _ in range(n)])
+            wall = time.perf_counter() - start
+            failed = [status for status, *_ in results if " 200 " not in status + " "]
+            firsts = [first for _, first, _, _ in results if first is not None]
+            totals = [total for _, _, total, _ in results]
+            print(f"{n:3} clients: {n / wall:.2f} requests/s, first audio p50 {percentile(firsts, 50):.3f}s "
+                  f"p99 {percentile(firsts, 99):.3f}s, total p50 {percentile(totals, 50):.3f}s p99 {percentile(totals, 99):.3f}s"
+                  + (f", {len(failed)} failed" if failed else ""))
+        stats = service.stats()
+        print(f"{stats['batches']} batches, {stats['avg_batch']:.1f} sentences per batch on average")
+        server.close()
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+def bench_compiled(converter, txt, threads):
+    # real time factor of the eager and the compiled models, each measured after a warm up run
+    converter.audio_cache_size = converter.mel_cache_size = 0
+    converter.intra_op_threads, converter.inter_op_threads = threads
+    results = {}
+    for compiled in (False, True):
+        converter.set_compiled(compiled)
+        run_job(converter, txt[:200])  # compiles (or loads the compiled models) outside of the measurement
+        stats = run_job(converter, txt)
+        results[compiled] = stats["synthesis_seconds"] / stats.get("audio_seconds", 1)
+        print(f"{'compiled' if compiled else 'eager':>8}: RTF {results[compiled]:.3f} "
+              f"(acoustic model {stats.get('acoustic_seconds', 0):.2f}s, vocoder {stats.get('vocoder_seconds', 0):.2f}s)")
+    print(f"compiled models are {results[False] / results[True]:.2f}x as fast")
+    return results
+
+
+def bench_quantized(converter, txt, max_distance):
+    # real time factor of the fp32 and the int8 models, and the quality check of the quantized ones against fp32
+    converter.audio_cache_size = converter.mel_cache_size = 0
+    results = {}
+    for quantized in (False, True):
+        converter.set_quantized(quantized, max_distance)
+        run_job(converter, txt[:200])  # quantizes and checks the models outside of the measurement
+        stats = run_job(converter, txt)
+        results[quantized] = stats["synthesis_seconds"] / stats.get("audio_seconds", 1)
+        print(f"{'int8' if quantized else 'fp32':>5}: RTF {results[quantized]:.3f} "
+              f"(acoustic model {stats.get('acoustic_seconds', 0):.2f}s, vocoder {stats.get('vocoder_seconds', 0):.2f}s)")
+    print(f"quantized models are {results[False] / results[True]:.2f}x as fast")
+    for kind, distance in converter.quantized_distances.items():
+        print(f"{'PASS' if distance <= max_distance else 'FAIL'}: {kind} {distance:.2f} dB log spectral distance "
+              f"to fp32, {max_distance} dB allowed")
+    return all(distance <= max_distance for distance in converter.quantized_distances.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Speech synthesizer benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+    batch = sub.add_parser("batch", help="synthesis throughput per batch size")
+    batch.add_argument("file")
+    batch.add_argument("--sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    batch.add_argument("--lang", default="zh")
+    swap = sub.add_parser("vocoder-swap", help="re-render time after a vocoder change, with and without the mel cache")
+    swap.add_argument("file")
+    swap.add_argument("--vocoders", nargs="+", default=["parallel_wavegan", "multi_band_melgan"])
+    swap.add_argument("--lang", default="zh")
+    memory = sub.add_parser("memory", help="peak memory with and without chunked vocoding")
+    memory.add_argument("files", nargs="+")
+    memory.add_argument("--chunks", type=int, nargs="+", default=[0, 1000])
+    memory.add_argument("--lang", default="zh")
+    segments = sub.add_parser("segments", help="real time factor per re-segmentation target length")
+    segments.add_argument("file")
+    segments.add_argument("--targets", type=int, nargs="+", default=[0, 20, 40, 80])
+    segments.add_argument("--lang", default="zh")
+    shards = sub.add_parser("shards", help="scaling curve of multi-process synthesis")
+    shards.add_argument("file")
+    shards.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    shards.add_argument("--threads", type=int, default=0, help="torch threads per worker, 0 splits the cores evenly")
+    shards.add_argument("--lang", default="zh")
+    normalize = sub.add_parser("normalize", help="chars per second of the Chinese text normalization, checked against the reference")
+    normalize.add_argument("files", nargs="+")
+    normalize.add_argument("--repeat", type=int, default=20)
+    numbers = sub.add_parser("numbers", help="correctness and throughput of the Chinese number verbalizer")
+    numbers.add_argument("--repeat", type=int, default=5)
+    suite = sub.add_parser("suite", help="per-stage timings, RTF and peak memory of headless jobs, saved as JSON to compare runs")
+    suite.add_argument("files", nargs="*", default=sorted(glob.glob("demo_txt_files/*.txt")))
+    suite.add_argument("--lang", help="skip language detection and use this language")
+    suite.add_argument("--stub", action="store_true", help="deterministic stub models instead of the real ones, runs offline")
+    suite.add_argument("--acoustic-cost", type=int, default=1, help="layers the stub acoustic model runs")
+    suite.add_argument("--vocoder-cost", type=int, default=1, help="layers the stub vocoder runs")
+    suite.add_argument("--out", help="JSON file for the results")
+    suite.add_argument("--compare", help="results JSON of an earlier run to compare against")
+    service = sub.add_parser("service", help="latency and throughput of the HTTP service with concurrent clients on localhost")
+    service.add_argument("file")
+    service.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32])
+    service.add_argument("--max-batch", type=int, default=8)
+    service.add_argument("--window-ms", type=float, default=20)
+    service.add_argument("--stub", action="store_true", help="deterministic stub models instead of the real ones")
+    compiled = sub.add_parser("compiled", help="real time factor of the eager and the traced models")
+    compiled.add_argument("file")
+    compiled.add_argument("--lang", default="zh")
+    compiled.add_argument("--cpu", action="store_true", help="hide the GPU")
+    compiled.add_argument("--threads", type=int, nargs=2, default=[0, 0], metavar=("INTRA", "INTER"),
+                          help="torch intra-op and inter-op threads, 0 keeps torch's default")
+    quantized = sub.add_parser("quantized", help="real time factor and fidelity of the int8 models against fp32, on CPU")
+    quantized.add_argument("file")
+    quantized.add_argument("--lang", default="zh")
+    quantized.add_argument("--max-distance", type=float, default=2.0, help="dB of log spectral distance to fp32 allowed")
+    args = parser.parse_args()
+
+    if args.bench == "normalize":
+        return bench_normalize(args.files, args.repeat)
+    if args.bench == "numbers":
+        return bench_numbers(args.repeat)
+    if args.bench == "memory":
+        return bench_memory(args.files, args.lang, args.chunks)
+    if args.bench == "service":
+        from stub_models import stub_loader
+        return bench_service(read_text(args.file), args.clients, stub_loader() if args.stub else load_models,
+                             args.max_batch, args.window_ms)
+    if args.bench == "suite":
+        from stub_models import stub_loader
+        loader = stub_loader(args.acoustic_cost, args.vocoder_cost) if args.stub else load_models
+        return bench_suite(args.files, args.lang, loader, args.out, args.compare)
+    if getattr(args, "cpu", False) or args.bench == "quantized": os.environ["CUDA_VISIBLE_DEVICES"] = ""  # before torch is imported
+    converter = Converter(lang=args.lang, background=False)
+    converter.autoDetectLang = False
+    if args.bench == "batch":
+        bench_batch(converter, read_text(args.file), args.sizes)
+    elif args.bench == "vocoder-swap":
+        bench_vocoder_swap(converter, read_text(args.file), args.vocoders)
+    elif args.bench == "segments":
+        bench_segments(converter, read_text(args.file), args.targets)
+    elif args.bench == "compiled":
+        bench_compiled(converter, read_text(args.file), args.threads)
+    elif args.bench == "quantized":
+        return bench_quantized(converter, read_text(args.file), args.max_distance)
+    elif args.bench == "shards":
+        bench_shards(converter, read_text(args.file), args.workers, args.threads)
+
+
+if __name__ == '__main__':
+    exit(0 if main() is not False else 1)   # correctness checks like numbers and normalize fail the run
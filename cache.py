@@ -0,0 +1,77 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+class ArrayCache:
+    # content addressed on-disk cache of numpy arrays, evicts the least recently used entries above max_bytes
+    def __init__(self, directory, max_bytes):
+        os.makedirs(directory, exist_ok=True)
+        self.dir = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> file size, least recently used first
+        files = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".npy"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+        self.size = sum(self.entries.values())
+        self.evict()
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1("\0".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.dir, key + ".npy")
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        import numpy as np
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+        try:
+            arr = np.load(self.path(key))
+            os.utime(self.path(key))  # mtime keeps the LRU order across restarts
+        except (OSError, ValueError):
+            with self.lock:
+                self.size -= self.entries.pop(key, 0)
+                self.misses += 1
+            return None
+        with self.lock: self.hits += 1
+        return arr
+
+    def put(self, key, arr):
+        import numpy as np
+        tmp = self.path(key) + f".{os.getpid()}.{threading.get_ident()}.tmp"  # unique across the worker processes sharing the directory
+        with open(tmp, "wb") as f:
+            np.save(f, arr)
+        os.replace(tmp, self.path(key))
+        with self.lock:
+            self.size -= self.entries.pop(key, 0)
+            self.entries[key] = os.path.getsize(self.path(key))
+            self.size += self.entries[key]
+            self.evict()
+
+    def evict(self):
+        while self.size > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        return f"{self.hits} hits, {self.misses} misses, {len(self.entries)} entries ({self.size / 2 ** 20:.1f}MB)"
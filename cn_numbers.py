@@ -0,0 +1,94 @@
+import re
+from functools import lru_cache
+from itertools import groupby
+
+# reads the numbers in a Chinese sentence according to their context, in one pass over the sentence.
+# plain numbers are read like num2chinese does, years, phone numbers and IDs digit by digit,
+# dates, ranges and percentages as a whole
+
+DIGITS = "零一二三四五六七八九"
+PHONE_DIGITS = "零幺二三四五六七八九"  # 1 is read yao in phone numbers and IDs
+SMALL_UNITS = "十百千"
+LARGE_UNITS = "万亿兆京垓秭穰沟涧正载"
+MEASURE_WORDS = "个只本次天位条件张名种家台辆块"  # a lone 2 in front of these is read 两, unless it's an ordinal (第2名)
+RANGE_SEPARATORS = "-~～—–"
+DURATION_AFTER_YEAR = "前后来间代内左多余历"  # 年 followed by these is a number of years (5000年前), not a year
+PER = {"%": "百分之", "％": "百分之", "‰": "千分之"}
+
+_NUMBER_RE = re.compile(
+    rf"(?P<date>(?<![\d.])(?P<year>\d{{4}})(?P<sep>[-/.])(?P<month>\d{{1,2}})(?P=sep)(?P<day>\d{{1,2}})(?![\d.]))"
+    rf"|(?P<phone>(?<![\d.])(?:\d{{17}}[\dXx]|\d{{15}}|1[3-9]\d{{9}}|0\d{{2,3}}-\d{{7,8}}|0\d{{2,}})(?![\d.]))"
+    rf"|(?P<years>(?<![\d.])\d{{4}}(?:[{RANGE_SEPARATORS}至到]\d{{4}})?)(?=年(?![{DURATION_AFTER_YEAR}]|的历史))"
+    rf"|(?P<range>(?<![\d.])(?P<low>\d+(?:\.\d+)?)[{RANGE_SEPARATORS}](?P<high>\d+(?:\.\d+)?)(?![\d.]))"
+    rf"|(?P<percent>[+-]?\d+(?:\.\d+)?)(?P<per>[{''.join(PER)}])"
+    rf"|(?P<two>(?<![\d.第])2)(?=[{MEASURE_WORDS}])"
+    rf"|(?P<number>[+-]?\d+\.?\d*)")
+_PLAIN_RE = re.compile(r"[+-]?\d+\.?\d*")
+_DIGIT_SEPARATORS = str.maketrans({"-": "，"})
+
+
+def _collapse(parts):
+    # merges repeated neighbouring parts, e.g. the zeros of 1001
+    return "".join(k for k, _ in groupby(parts))
+
+
+@lru_cache(maxsize=None)
+def _group(n):
+    # one group of four digits
+    unit = str(n).zfill(4)
+    parts = []
+    for nc, ch in enumerate(reversed(unit)):
+        if ch == "0":
+            if parts: parts.append(DIGITS[0])
+        elif nc == 0: parts.append(DIGITS[int(ch)])
+        elif nc == 1 and ch == "1" and unit[1] == "0": parts.append(SMALL_UNITS[0])  # 十四, 三千零十四
+        else: parts.append(DIGITS[int(ch)] + SMALL_UNITS[nc - 1])
+    return _collapse(reversed(parts))
+
+
+def _integer(integer):
+    if not int(integer): return DIGITS[0]
+    groups = [int(integer[max(i - 4, 0):i]) for i in range(len(integer), 0, -4)]
+    parts = []
+    for nu, n in enumerate(groups):
+        if n == 0: parts.append(DIGITS[0])
+        elif nu and n == 2: parts.append("二" + LARGE_UNITS[nu - 1])  # 0002 of a higher group, no leading zero
+        else: parts.append(_group(n) + (LARGE_UNITS[nu - 1] if nu else ""))
+    return _collapse(reversed(parts)).strip(DIGITS[0])
+
+
+def digits(s, table=DIGITS):
+    # digit by digit, anything that isn't a digit is kept
+    return "".join(table[int(ch)] if ch.isdecimal() else ch for ch in s)
+
+
+@lru_cache(maxsize=4096)
+def cardinal(num):
+    # same reading as num2chinese(num), numbers too long for its units are read digit by digit
+    sign = "正" if num[0] == "+" else "负" if num[0] == "-" else ""
+    integer, _, remainder = num.lstrip("+-").partition(".")
+    integer = _integer(integer) if len(integer) <= 4 * (len(LARGE_UNITS) + 1) else digits(integer)
+    return sign + integer + ("点" + digits(remainder) if remainder else "")
+
+
+def _plain(s):
+    return _PLAIN_RE.sub(lambda m: cardinal(m.group(0)), s)
+
+
+def _verbalize(m):
+    if m.group("date"):
+        month, day = int(m.group("month")), int(m.group("day"))
+        if not 1 <= month <= 12 or not 1 <= day <= 31: return _plain(m.group(0))
+        return digits(m.group("year")) + "年" + cardinal(m.group("month")) + "月" + cardinal(m.group("day")) + "日"
+    if m.group("phone"): return digits(m.group("phone"), PHONE_DIGITS).translate(_DIGIT_SEPARATORS)
+    if m.group("years"): return digits(re.sub(f"[{RANGE_SEPARATORS}到]", "至", m.group("years")))
+    if m.group("range"):
+        if float(m.group("low")) >= float(m.group("high")): return _plain(m.group(0))
+        return cardinal(m.group("low")) + "至" + cardinal(m.group("high"))
+    if m.group("percent"): return PER[m.group("per")] + cardinal(m.group("percent"))
+    if m.group("two"): return "两"
+    return cardinal(m.group("number"))
+
+
+def verbalize_numbers(s):
+    return _NUMBER_RE.sub(_verbalize, s)
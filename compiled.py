@@ -0,0 +1,151 @@
+import os
+import re
+
+import numpy as np
+import torch
+
+# traced versions of the acoustic model and the vocoder, installed in place of their eager inference methods.
+# a model is only traced if the traced version gives the same output as the eager one for an input of another length
+# than the one it was traced with, otherwise it stays eager. traces are saved per model tag, device and torch version,
+# so later startups load them instead of tracing again, models that can't be traced are remembered as well
+
+PROBES = {  # (traced with, checked with)
+    "zh": ("你好，欢迎使用语音合成。", "今天的天气非常好，我们一起去公园散步吧，顺便买点水果回来。"),
+    "en": ("Hello, and welcome.", "The weather is lovely today, so we are going for a long walk in the park after lunch."),
+}
+
+
+def inference_mode():
+    # torch.inference_mode on torch >= 1.9, no_grad before that
+    return torch.inference_mode() if hasattr(torch, "inference_mode") else torch.no_grad()
+
+
+def set_thread_policy(intra_op=0, inter_op=0, log=print):
+    # 0 keeps torch's default, inter-op threads can only be changed before torch runs anything in parallel
+    if intra_op: torch.set_num_threads(intra_op)
+    if inter_op and inter_op != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError:
+            log("Inter-op threads can only be set before the first conversion, restart to change them")
+    log(f"Torch threads: {torch.get_num_threads()} intra-op, {torch.get_num_interop_threads()} inter-op")
+
+
+def artifact_path(directory, tag, device, kind):
+    return os.path.join(directory, re.sub(r"[^\w.-]", "_", f"{tag}.{device}.torch{torch.__version__}.{kind}") + ".pt")
+
+
+class TracedTTS(torch.nn.Module):
+    # stands in for the Text2Speech model's tts module, the traced forward only covers the default inference settings
+    def __init__(self, traced, eager, dict_output):
+        super().__init__()
+        self.traced = traced
+        self.eager = eager
+        self.dict_output = dict_output
+
+    def inference(self, text, speech=None, spembs=None, durations=None, alpha=1.0, use_teacher_forcing=False, **kwargs):
+        if speech is not None or spembs is not None or durations is not None or alpha != 1.0 or use_teacher_forcing \
+                or any(v is not None for v in kwargs.values()):
+            return self.eager.inference(text, speech=speech, spembs=spembs, durations=durations, alpha=alpha,
+                                        use_teacher_forcing=use_teacher_forcing, **kwargs)
+        feats = self.traced(text)
+        return {"feat_gen": feats} if self.dict_output else (feats, None, None)
+
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(self._modules["eager"], name)
+
+
+class AcousticForward(torch.nn.Module):
+    # the features of the default inference of a tts module, as a forward to trace
+    def __init__(self, tts):
+        super().__init__()
+        self.tts = tts
+
+    def forward(self, text):
+        out = self.tts.inference(text)
+        return out["feat_gen"] if isinstance(out, dict) else out[0]
+
+
+def _tokens(text2speech, t):
+    # the token ids Text2Speech feeds to the model for a sentence
+    tokens = text2speech.preprocess_fn("<dummy>", dict(text=t))["text"]
+    return torch.from_numpy(np.asarray(tokens)).long().to(text2speech.device)
+
+
+def _same(a, b):
+    return a.shape == b.shape and torch.allclose(a, b, rtol=1e-3, atol=1e-4)
+
+
+def _run(fn, *args):
+    torch.manual_seed(0)  # the same noise for the eager and traced run of vocoders that draw it
+    with inference_mode():
+        return fn(*args)
+
+
+def _traced(path, device, trace, log, what):
+    # loads the saved trace, or traces and saves it. None if the model can't be traced
+    if os.path.exists(path + ".failed"): return None
+    if os.path.exists(path):
+        try:
+            return torch.jit.load(path, map_location=device)
+        except Exception as e:
+            log(f"Couldn't load compiled {what}, tracing it again: {e}")
+    try:
+        traced = trace()
+    except Exception as e:
+        log(f"Couldn't compile {what}, running it eagerly: {e}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".failed", encoding="utf-8", mode="w") as f:
+            f.write(str(e))
+        return None
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    torch.jit.save(traced, path)
+    return traced
+
+
+def compile_models(text2speech, vocoder, tag, vocoder_tag, device, language, directory, log=print):
+    # installs the traced models, returns which ones are compiled
+    if isinstance(text2speech.model.tts, TracedTTS) or "inference" in vocoder.__dict__:
+        return isinstance(text2speech.model.tts, TracedTTS), "inference" in vocoder.__dict__
+    short, long = PROBES.get(language, PROBES["en"])
+    tts = text2speech.model.tts
+    expected_feats = _run(lambda t: text2speech(t)[1], long)
+
+    def trace_acoustic():
+        if "FastSpeech" not in type(tts).__name__: raise ValueError(f"only FastSpeech models are traced, not {type(tts).__name__}")
+        forward = AcousticForward(tts)
+        with torch.no_grad():
+            traced = torch.jit.trace(forward, _tokens(text2speech, short), check_trace=False)
+        if not _same(_run(traced, _tokens(text2speech, long)), _run(forward, _tokens(text2speech, long))):
+            raise ValueError("traced output differs for other sentence lengths")
+        return traced
+
+    traced = _traced(artifact_path(directory, tag, device, "acoustic"), device, trace_acoustic, log, f"acoustic model {tag}")
+    if traced is not None:
+        text2speech.model.tts = TracedTTS(traced, tts, isinstance(_run(tts.inference, _tokens(text2speech, short)), dict))
+        if not _same(_run(lambda t: text2speech(t)[1], long), expected_feats):
+            log(f"Compiled acoustic model {tag} differs from the eager one, running it eagerly")
+            text2speech.model.tts = tts
+
+    def trace_vocoder():
+        short_feats = _run(lambda t: text2speech(t)[1], short)
+        with torch.no_grad():
+            traced = torch.jit.trace_module(vocoder, {"inference": short_feats}, check_trace=False)
+        if not _same(_run(traced.inference, expected_feats), _run(vocoder.inference, expected_feats)):
+            raise ValueError("traced output differs for other feature lengths")
+        return traced
+
+    traced = _traced(artifact_path(directory, vocoder_tag, device, "vocoder"), device, trace_vocoder, log, f"vocoder {vocoder_tag}")
+    if traced is not None: vocoder.inference = traced.inference
+    compiled = isinstance(text2speech.model.tts, TracedTTS), "inference" in vocoder.__dict__
+    log(f"Compiled models: acoustic model {'traced' if compiled[0] else 'eager'}, vocoder {'traced' if compiled[1] else 'eager'}")
+    return compiled
+
+
+def restore_models(text2speech, vocoder):
+    # back to the eager models
+    if isinstance(text2speech.model.tts, TracedTTS): text2speech.model.tts = text2speech.model.tts.eager
+    vocoder.__dict__.pop("inference", None)
@@ -1,11 +1,23 @@
 import concurrent
+import json
 import os
 import time
 import shutil
+import threading
+import uuid
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
 from concurrent.futures.thread import ThreadPoolExecutor
 
-from util import parse_lrc_time, parse_srt_time, replace_with_cn_num, cn_sent_tokenize, preprocess_cn_text, get_full_esp_model_tag, \
-    get_full_vocoder_model_tag, general_preprocess
+from cache import ArrayCache
+from model_pool import ModelPool
+from jobs import Job, JobQueue
+from manifest import JobManifest
+from metrics import Metrics
+from wav_writer import HEADER_SIZE, WavWriter
+
+from util import parse_lrc_time, parse_srt_time, replace_with_cn_num, iter_sentences, preprocess_cn_text, get_full_esp_model_tag, \
+    get_full_vocoder_model_tag, general_preprocess, group_sentences, peak_rss, resegment, detect_segment_language
 
 import zmq
 
@@ -15,34 +27,229 @@ if "en" in sys_lang: sys_lang = "en"
 else: sys_lang = "zh"
 calibre_link = f"https://calibre-ebook.com{'' if sys_lang == 'en' else '/zh_CN'}/download"
 
+DATA_ADDRESS = "tcp://127.0.0.1:10291" # raw audio chunks when streaming, next to the [log] socket on 10290
+
 DATA_DIR = "./synthesizer_data"
 MODEL_DIR =DATA_DIR + "/models/"
+AUDIO_CACHE_DIR = DATA_DIR + "/audio_cache"
+MEL_CACHE_DIR = DATA_DIR + "/mel_cache"
+COMPILED_DIR = MODEL_DIR + "/compiled" # traced models, see compiled.py
+QUANTIZED_DIR = MODEL_DIR + "/quantized" # int8 weights, see quantized.py
+BATCH_GAP_FRAMES = 32 # silence frames between sentences vocoded together, wider than the vocoder's receptive field
+VOCODER_OVERLAP_FRAMES = 32 # context frames on each side of a vocoder chunk
+MIXED_WINDOW = 16 # units in flight when two models synthesize a mixed language document
+MIXED_MIN_CHARS = 200 # characters in other languages before a document is read with several models, so an ISBN or URL doesn't count
+METRICS_INTERVAL = 5 # seconds between [metrics] frames during a conversion
+PROFILE_TOP = 20 # hotspots in the log summary of a profiled job
+JOB_AUDIO_BYTES = 64 * 2 ** 20 # recent sentence audio kept for repeats when a job's sentences aren't known up front
 
 class HandledException(Exception):
     pass
 
+class JobCancelled(Exception):
+    pass
+
+def load_models(tag, vocoder_tag, device, log=print):
+    from espnet_model_zoo.downloader import ModelDownloader
+    from espnet2.bin.tts_inference import Text2Speech
+    from parallel_wavegan.utils import download_pretrained_model
+    from parallel_wavegan.utils import load_model
+
+    log("Loading espnet...")
+
+    d = ModelDownloader(MODEL_DIR + "/espnet_models")
+    text2speech = Text2Speech(
+        **d.download_and_unpack(tag),
+        device=device,
+        # Only for Tacotron 2
+        threshold=0.5,
+        minlenratio=0.0,
+        maxlenratio=10.0,
+        use_att_constraint=False,
+        backward_window=1,
+        forward_window=3,
+        # Only for FastSpeech & FastSpeech2
+        speed_control_alpha=1.0,
+    )
+    text2speech.spc2wav = None  # Disable griffin-lim
+    # NOTE: Sometimes download is failed due to "Permission denied". That is
+    #   the limitation of google drive. Please retry after serveral hours.
+
+    log("Loading vocoder models...")
+
+    vocoder = load_model(download_pretrained_model(vocoder_tag, download_dir=MODEL_DIR + "/vocoder_models")).to(device).eval()
+    vocoder.remove_weight_norm()
+    return text2speech, vocoder
+
+def load_features(mel_cache, key, device):
+    import torch
+    arr = mel_cache.get(key)
+    return None if arr is None else torch.from_numpy(arr.astype("float32")).to(device)
+
+def store_features(mel_cache, key, c):
+    mel_cache.put(key, c.cpu().numpy().astype("float16"))  # half precision is plenty for vocoder input
+
+def vocode(vocoder, c, chunk_frames=0, overlap=VOCODER_OVERLAP_FRAMES, check=None):
+    # long feature sequences are vocoded in chunks with overlap frames of context on both sides,
+    # neighbouring chunks are crossfaded over the middle of their overlap, so peak memory depends on chunk_frames only.
+    # check is called before every chunk, e.g. to stop a cancelled job
+    chunk_frames = max(chunk_frames, overlap) if chunk_frames > 0 else 0
+    if check: check()
+    if not chunk_frames or len(c) <= chunk_frames + overlap:
+        return vocoder.inference(c).view(-1)
+    import torch
+    half = overlap // 2
+    out, tail = [], None
+    s = 0
+    while s < len(c):
+        if check and s: check()
+        e = len(c) if len(c) - s <= chunk_frames + overlap else s + chunk_frames  # no tiny last chunk
+        a, b = max(0, s - overlap), min(len(c), e + overlap)
+        wav = vocoder.inference(c[a:b]).view(-1)
+        hop = len(wav) // (b - a)
+        piece = wav[(max(0, s - half) - a) * hop:(min(len(c), e + half) - a) * hop]
+        if tail is not None:
+            fade = torch.linspace(0, 1, len(tail), device=piece.device)
+            piece = torch.cat([tail * (1 - fade) + piece[:len(tail)] * fade, piece[len(tail):]])
+        if e < len(c):
+            out.append(piece[:-2 * half * hop])
+            tail = piece[-2 * half * hop:]
+        else:
+            out.append(piece)
+        s = e
+    return torch.cat(out)
+
+def synthesize(text2speech, vocoder, t, seed=None, mel_cache=None, mel_key=None, chunk_frames=0, check=None):
+    # seeding per sentence makes the output independent of which process or order the sentence is synthesized in,
+    # the vocoder is seeded again so it doesn't matter whether the features came from the acoustic model or the cache
+    import torch
+    with torch.no_grad():
+        c = load_features(mel_cache, mel_key, text2speech.device) if mel_cache else None
+        if c is None:
+            if seed is not None: torch.manual_seed(seed)
+            c = text2speech(t)[1]
+            if mel_cache: store_features(mel_cache, mel_key, c)
+        if seed is not None: torch.manual_seed(seed)
+        return vocode(vocoder, c, chunk_frames, check=check)
+
 # noinspection PyAttributeOutsideInit
 class Converter:
     def comm(self, cmd, msg=""):
+        # called from the save, pipeline and synthesis threads too, zmq sockets aren't thread safe
+        if not self.socket: return
         try:
-            self.socket.send_string(cmd + "|" + msg, zmq.NOBLOCK)
+            with self.socket_lock:
+                self.socket.send_string(cmd + "|" + msg, zmq.NOBLOCK)
         except zmq.error.Again:
             print("No subscriber. Send again later:", cmd, msg)
 
     def log(self, msg):
         self.comm("[log]", msg)
 
-    def __init__(self, out_dir=".", out_name="out", comm=None, lang="zh", background=True):
+    def publish_metrics(self, force=False):
+        # [metrics]|{"name{labels}": value, ...}, at most every METRICS_INTERVAL seconds unless forced
+        if not force and time.time() - self.metrics_sent < METRICS_INTERVAL: return
+        self.metrics_sent = time.time()
+        self.comm("[metrics]", json.dumps(self.metrics.snapshot()))
+
+    def serve_metrics(self, port):
+        # text exposition endpoint on http://127.0.0.1:port/metrics for scraping, 0 stops it
+        from metrics import serve
+        if self.metrics_server and self.metrics_server.server_address[1] == port: return
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.metrics_server = None
+        if port:
+            try:
+                self.metrics_server = serve(self.metrics, port)
+            except (OSError, OverflowError) as e:  # port in use, not permitted or out of range
+                self.output_status(f"[ERROR] couldn't serve metrics on port {port}: {e}")
+                return
+            self.output_status(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+
+    def collect_metrics(self, metrics):
+        # gauges of state that isn't counted as it changes, read on every scrape and [metrics] frame
+        metrics.set("queue_depth", sum(not task.done() for task in self.save_tasks), queue="save")
+        for stage in getattr(self.pipeline, "stages", ()):
+            metrics.set("queue_depth", stage.queue.qsize(), queue=stage.name)
+        for name, cache in (("audio", self.audio_cache), ("mel", self.mel_cache)):
+            if not cache: continue
+            metrics.set("cache_hits", cache.hits, cache=name)
+            metrics.set("cache_misses", cache.misses, cache=name)
+            metrics.set("cache_bytes", cache.size, cache=name)
+        metrics.set("models_resident", len(self.model_pool.models))
+        metrics.set("models_bytes", self.model_pool.size())
+
+    def timed_loader(self, loader):
+        # the model pool's loader, with the load times recorded
+        def load(tag, vocoder_tag, device, log=print):
+            start = time.perf_counter()
+            models = loader(tag, vocoder_tag, device, log=log)
+            self.metrics.observe("model_load_seconds", time.perf_counter() - start)
+            self.metrics.inc("model_loads_total")
+            return models
+        return load
+
+    def stream_audio(self, wav):
+        # multipart [b"[audio]", b"job_id|seq|sample_rate|dtype", raw samples], the samples are sent without copying
+        if self.stream_seq == 0:
+            self.job_stats["ttfa"] = time.time() - self.job_stats["job_start"]
+            self.output_status(f"Time to first audio: {self.job_stats['ttfa']:.3f}s")
+        self.stream_seq += 1
+        if not self.streaming: return
+        arr = wav.view(-1).cpu().numpy() if hasattr(wav, "cpu") else wav
+        header = f"{self.job_id}|{self.stream_seq - 1}|{self.sample_rate}|{arr.dtype.name}".encode()
+        try:
+            with self.socket_lock:
+                if not self.data_socket:
+                    self.data_socket = zmq.Context.instance().socket(zmq.PUB)
+                    self.data_socket.bind(DATA_ADDRESS)
+                    self.data_socket.setsockopt(zmq.LINGER, 0)
+                self.data_socket.send_multipart([b"[audio]", header, arr], flags=zmq.NOBLOCK, copy=False)
+        except zmq.error.Again:
+            print("No audio subscriber, dropped chunk", self.stream_seq - 1)
+
+    def end_stream(self):
+        if not self.streaming or not self.data_socket: return
+        try:
+            with self.socket_lock:
+                self.data_socket.send_multipart([b"[audio-end]", f"{self.job_id}|{self.stream_seq}|{self.sample_rate}|".encode()],
+                                                flags=zmq.NOBLOCK)
+        except zmq.error.Again:
+            pass
+
+    def __init__(self, out_dir=".", out_name="out", comm=None, lang="zh", background=True, loader=load_models,
+                 model_pool=None, publish=True, print_log=True):
+        # loader(tag, vocoder_tag, device, log) returns (acoustic model, vocoder), e.g. stub_models.stub_loader().
+        # converters in the same process can share a model_pool, only one of them can publish on the ZMQ sockets
         print("CONVERTER RUNNING!")
+        self.print_log = print_log
         self.custom_esp = None
         self.custom_vocoder = None
         self.tag = None
         self.vocoder_tag = None
         self.model_reload_needed = False
-        self.socket = zmq.Context().socket(zmq.PUB)
-        self.socket.bind("tcp://127.0.0.1:10290")
-        self.socket.setsockopt(zmq.LINGER, 0)
+        self.model_memory = 2048 # MB of models kept loaded, the least recently used ones are unloaded above it
+        self.metrics = Metrics()
+        self.metrics_sent = 0
+        self.metrics_server = None
+        self.model_pool = model_pool or ModelPool(self.timed_loader(loader), self.model_memory * 2 ** 20)
+        self.socket = None
+        self.socket_lock = threading.Lock() # for both sockets
+        if publish:
+            self.socket = zmq.Context().socket(zmq.PUB)
+            self.socket.bind("tcp://127.0.0.1:10290")
+            self.socket.setsockopt(zmq.LINGER, 0)
+        self.data_socket = None
+        self.streaming = False
+        self.job_id = None
+        self.stream_seq = 0
         self.convert_executor = ThreadPoolExecutor(max_workers=1)
+        self.jobs = JobQueue()
+        self.cancel_event = threading.Event()
+        self.resume_event = threading.Event() # cleared while the running job is paused
+        self.resume_event.set()
         if background: self.convert_executor.submit(self._initialize, out_dir, out_name, comm, lang)
         else: self._initialize(out_dir, out_name, comm, lang)
         # print("Converter exited init")
@@ -56,12 +263,49 @@ class Converter:
             self.out_name = out_name
             self.force_calibre = False
             self.autoDetectLang = True
+            self.mixed_language = True # detect the language per paragraph and read each with its own model
+            self.voices = {}
+            self.unit_languages = None
+            self.resamplers = {}
+            self.batch_size = 1
+            self.pipelined = False
+            self.pipeline_queue_size = 4
+            self.num_workers = 1
+            self.threads_per_worker = 0 # 0: split the cores evenly between the workers
+            self.shard_pool = None
+            self.segment_target = 0 # target characters per synthesis unit, 0 keeps the tokenizer's sentences
+            self.vocoder_chunk_frames = 1000 # longer feature sequences are vocoded in chunks, 0 disables chunking
+            self.compiled = False # traced models run under torch.inference_mode, see compiled.py
+            self.quantized = False # int8 models on CPU, takes precedence over compiled, see quantized.py
+            self.quantized_max_distance = 2.0 # dB of log spectral distance to fp32 a quantized model may have
+            self.quantized_distances = {} # measured when the models were quantized, by model kind
+            self.intra_op_threads = 0 # torch threads, 0 keeps torch's default
+            self.inter_op_threads = 0
+            self.audio_cache_size = 1024 # MB, 0 disables the cache
+            self.audio_cache = None
+            self.mel_cache_size = 1024 # MB, 0 disables the cache
+            self.mel_cache = None
+            self.job_audio = OrderedDict()
+            self.job_audio_bytes = 0
+            self.job_audio_lock = threading.Lock()
+            self.job_repeated = set()
+            self.job_stats = {}
+            self.profile = False # profile the next jobs, see profiled_convert
+            self.pipeline = None
+            self.save_tasks = []
+            self.metrics.add_collector(self.collect_metrics)
             if lang:
                 self.language = lang
                 self.setup_model_config()
                 self.setup_model()
             self.save_executor = ThreadPoolExecutor(max_workers=1)
-            self.save_tasks = []
+            self.writer = None
+            self.manifest = None
+            self.previous_units = {}
+            self.previous_audio = None
+            self.units = {}
+            self.unit_total = None
+            self.subtitle_files = None
             self.output_status("Converter initialized.")
         except HandledException:
             raise
@@ -70,7 +314,7 @@ class Converter:
             self.output_err("Initialization error", e)
 
     def output_status(self, s: str, end="\n"):
-        print(s, end=end)
+        if self.print_log: print(s, end=end)
         self.log(s + end)
 
     def use_calibre(self, file):
@@ -114,8 +358,9 @@ class Converter:
 
     def preprocess_text(self):
         import re
-        self.txt = self.txt.strip().replace("\n\n","\n")
-        self.txt = re.sub(r'\n+','\n\n',self.txt)
+        with self.timed("preprocess"):
+            self.txt = self.txt.strip().replace("\n\n","\n")
+            self.txt = re.sub(r'\n+','\n\n',self.txt)
 
         if len(self.txt) == 0:
             self.output_status("Input is empty/invalid")
@@ -139,7 +384,8 @@ class Converter:
         # lang = b.detect_language()
         from langdetect import detect, DetectorFactory
         DetectorFactory.seed = 0 # enforcing consistent output
-        lang = detect(self.txt[:1000])
+        with self.timed("detect"):
+            lang = detect(self.txt[:1000])
 
         if "zh" in lang: lang = "zh"
         self.output_status("English" if lang == 'en' else "中文（普通话）")
@@ -167,47 +413,51 @@ class Converter:
             if executor: self.convert_executor.submit(self.setup_model)
             else: self.setup_model()
 
-    def setup_model_config(self):
-        old_tag = self.tag
-        old_vocoder_tag = self.vocoder_tag
-        self.sample_rate, self.lang, self.tag, self.vocoder_tag = None, None, None, None
-        if self.language == 'en':
+    def model_config(self, language):
+        # (sample rate, language name, acoustic model tag, vocoder tag) of a language, with the custom models applied
+        sample_rate, lang, tag, vocoder_tag = None, None, None, None
+        if language == 'en':
             ###################################
             #          ENGLISH MODELS         #
             ###################################
-            self.sample_rate, self.lang = 22050, "English"
+            sample_rate, lang = 22050, "English"
             corpus = "ljspeech"
             speech_model = "conformer_fastspeech2"
             # speech_model = "fastspeech2"
             # speech_model = "tacotron2"
-            self.tag = "kan-bayashi/" + corpus + "_" + speech_model
+            tag = "kan-bayashi/" + corpus + "_" + speech_model
             # tag = "kan-bayashi/ljspeech_tacotron2"
             # tag = "kan-bayashi/jsut_tacotron2"
             # tag = "kan-bayashi/ljspeech_fastspeech"
             # tag = "kan-bayashi/ljspeech_fastspeech2"
             # tag = "kan-bayashi/ljspeech_conformer_fastspeech2"
 
-            self.vocoder_tag = "ljspeech_parallel_wavegan.v3"
+            vocoder_tag = "ljspeech_parallel_wavegan.v3"
             # vocoder_tag = "ljspeech_full_band_melgan.v2"
             # vocoder_tag = "ljspeech_multi_band_melgan.v2"
-        elif 'zh' in self.language:
-            self.language = 'zh'
-
+        elif 'zh' in language:
             ###################################
             #         MANDARIN MODELS         #
             ###################################
-            self.sample_rate, self.lang = 24000, "Mandarin"
+            sample_rate, lang = 24000, "Mandarin"
             # tag = "kan-bayashi/csmsc_tacotron2"
             # tag = "kan-bayashi/csmsc_transformer"
             # tag = "kan-bayashi/csmsc_fastspeech"
             # tag = "kan-bayashi/csmsc_fastspeech2"
-            self.tag = "kan-bayashi/csmsc_conformer_fastspeech2"
-            self.vocoder_tag = "csmsc_parallel_wavegan.v1"
+            tag = "kan-bayashi/csmsc_conformer_fastspeech2"
+            vocoder_tag = "csmsc_parallel_wavegan.v1"
             # vocoder_tag = "csmsc_multi_band_melgan.v2"
         if self.custom_esp:
-            self.tag = get_full_esp_model_tag(self.custom_esp, self.language)
+            tag = get_full_esp_model_tag(self.custom_esp, language)
         if self.custom_vocoder:
-            self.vocoder_tag = get_full_vocoder_model_tag(self.custom_vocoder, self.language)
+            vocoder_tag = get_full_vocoder_model_tag(self.custom_vocoder, language)
+        return sample_rate, lang, tag, vocoder_tag
+
+    def setup_model_config(self):
+        old_tag = self.tag
+        old_vocoder_tag = self.vocoder_tag
+        if 'zh' in self.language: self.language = 'zh'
+        self.sample_rate, self.lang, self.tag, self.vocoder_tag = self.model_config(self.language)
         if old_tag != self.tag or old_vocoder_tag != self.vocoder_tag:
             self.model_reload_needed = True
 
@@ -225,105 +475,590 @@ class Converter:
                 nltk.download('punkt', download_dir=MODEL_DIR + "/nltk_models")
 
             self.output_status("Loading torch...", end=" ")
-
-            # setup model
             import torch
-            from espnet_model_zoo.downloader import ModelDownloader
-            from espnet2.bin.tts_inference import Text2Speech
-            from parallel_wavegan.utils import download_pretrained_model
-            from parallel_wavegan.utils import load_model
-
             self.mlDevice = "cuda" if torch.cuda.is_available() else "cpu"
             self.output_status("Running on " + self.mlDevice)
-
-            self.output_status("Loading espnet...")
-
-            d = ModelDownloader(MODEL_DIR + "/espnet_models")
-            self.text2speech = Text2Speech(
-                **d.download_and_unpack(self.tag),
-                device=self.mlDevice,
-                # Only for Tacotron 2
-                threshold=0.5,
-                minlenratio=0.0,
-                maxlenratio=10.0,
-                use_att_constraint=False,
-                backward_window=1,
-                forward_window=3,
-                # Only for FastSpeech & FastSpeech2
-                speed_control_alpha=1.0,
-            )
-            self.text2speech.spc2wav = None  # Disable griffin-lim
-            # NOTE: Sometimes download is failed due to "Permission denied". That is
-            #   the limitation of google drive. Please retry after serveral hours.
-
-            self.output_status("Loading vocoder models...")
-
-            self.vocoder = load_model(download_pretrained_model(self.vocoder_tag, download_dir=MODEL_DIR + "/vocoder_models")).to(self.mlDevice).eval()
-            self.vocoder.remove_weight_norm()
+            self.model_pool.log = self.output_status
+            self.model_pool.set_max_bytes(self.model_memory * 2 ** 20)
+            self.text2speech, self.vocoder = self.model_pool.get(self.tag, self.vocoder_tag, self.mlDevice)
+            self.setup_compiled()
             self.output_status("Model setup completed.")
         except Exception as e:
             self.output_err("Model error", e)
             raise HandledException()
 
+    def setup_compiled(self):
+        # the pooled models are restored to eager fp32, then quantized or traced in place if quantized or compiled is set
+        from compiled import compile_models, restore_models, set_thread_policy
+        from quantized import quantize_models, restore_models as restore_quantized
+        if self.intra_op_threads or self.inter_op_threads:
+            set_thread_policy(self.intra_op_threads, self.inter_op_threads, self.output_status)
+        self.quantized_distances = {}
+        if getattr(getattr(self.text2speech, "model", None), "tts", None) is None:  # e.g. the stub models
+            if self.compiled or self.quantized:
+                self.output_status("Only espnet models can be compiled or quantized, running them as they are")
+            return
+        try:
+            restore_quantized(self.text2speech, self.vocoder)
+            restore_models(self.text2speech, self.vocoder)
+            if self.quantized and self.mlDevice == "cpu":
+                self.quantized_distances = quantize_models(self.text2speech, self.vocoder, self.tag, self.vocoder_tag,
+                                                           self.language, QUANTIZED_DIR, self.quantized_max_distance,
+                                                           self.output_status)
+                return
+            if self.quantized: self.output_status("Quantized models only run on CPU, using the fp32 models")
+            if self.compiled:
+                compile_models(self.text2speech, self.vocoder, self.tag, self.vocoder_tag, self.mlDevice, self.language,
+                               COMPILED_DIR, self.output_status)
+        except Exception as e:  # e.g. models without the structure of espnet's Text2Speech
+            self.output_status(f"Couldn't compile the models, running them eagerly: {e}")
+
+    def set_compiled(self, compiled):
+        if compiled != self.compiled: self.model_reload_needed = True
+        self.compiled = compiled
+
+    def set_quantized(self, quantized, max_distance=None):
+        if max_distance is not None and max_distance != self.quantized_max_distance:
+            self.quantized_max_distance = max_distance
+            if quantized: self.model_reload_needed = True
+        if quantized != self.quantized: self.model_reload_needed = True
+        self.quantized = quantized
+
+    def inference_mode(self):
+        import torch
+        if self.compiled:
+            from compiled import inference_mode
+            return inference_mode()
+        return torch.no_grad()
+
+    def setup_voices(self):
+        # a document with paragraphs in both languages gets the models of each language, resident at the same time,
+        # voices maps a language to its (tag, vocoder tag, sample rate, acoustic model, vocoder), empty for one language
+        self.voices = {}
+        self.unit_languages = None
+        if not self.autoDetectLang or not self.mixed_language: return
+        with self.timed("detect"):
+            chars = Counter()
+            for language, text in self.language_segments(): chars[language] += len(text)
+        languages = set(chars)
+        if len(languages) < 2: return
+        other = sum(n for language, n in chars.items() if language != self.language)
+        if other < MIXED_MIN_CHARS:
+            self.output_status(f"Only {other} characters in other languages, reading the whole document as {self.lang}")
+            return
+        self.output_status(f"Mixed language document, reading {' and '.join(sorted(languages))} paragraphs with their own models")
+        for language in sorted(languages):
+            if language == self.language:
+                self.voices[language] = (self.tag, self.vocoder_tag, self.sample_rate, self.text2speech, self.vocoder)
+            else:
+                sample_rate, _, tag, vocoder_tag = self.model_config(language)
+                self.voices[language] = (tag, vocoder_tag, sample_rate, *self.model_pool.get(tag, vocoder_tag, self.mlDevice))
+        self.unit_languages = {}
+
+    def language_segments(self):
+        # consecutive paragraphs in the same language as (language, text),
+        # paragraphs without letters go with the ones before them
+        import re
+        language, paragraphs = None, []
+        for m in re.finditer(r"[^\n]+", self.txt):
+            detected = detect_segment_language(m.group(0)) or language
+            if paragraphs and language and detected != language:
+                yield language, "\n\n".join(paragraphs)
+                paragraphs = []
+            language = detected
+            paragraphs.append(m.group(0))
+        if paragraphs: yield language or self.language, "\n\n".join(paragraphs)
+
+    def resample(self, wav, sample_rate):
+        # to the job's sample rate, the resampling kernels are built once per rate pair
+        if sample_rate == self.sample_rate: return wav
+        if (sample_rate, self.sample_rate) not in self.resamplers:
+            import torchaudio
+            self.resamplers[(sample_rate, self.sample_rate)] = torchaudio.transforms.Resample(sample_rate, self.sample_rate)
+        return self.resamplers[(sample_rate, self.sample_rate)](wav.cpu())
+
+    @staticmethod
+    def setup_cache(cache, directory, size):
+        if size <= 0: return None
+        if not cache: return ArrayCache(directory, size * 2 ** 20)
+        if cache.max_bytes != size * 2 ** 20:
+            cache.max_bytes = size * 2 ** 20
+            with cache.lock: cache.evict()
+        return cache
+
     def pre_convert(self):
         self.preprocess_text()
         if self.model_reload_needed: self.setup_model()
-        if os.path.isfile(self.out_name + ".wav"): os.remove(self.out_name + ".wav")
+        self.audio_cache = self.setup_cache(self.audio_cache, AUDIO_CACHE_DIR, self.audio_cache_size)
+        self.mel_cache = self.setup_cache(self.mel_cache, MEL_CACHE_DIR, self.mel_cache_size)
 
-    def save_wav(self, wav, overwrite=False):
+    def open_output(self, units=None):
+        # a job with the same input, models and settings that was interrupted before is resumed from its manifest.
+        # returns the manifest entries of the units that are already in the output and the units to convert,
+        # which are only read into a list up front when the text was edited and the previous output is diffed against them
+        fname = f"{self.out_dir}/{self.out_name}.wav"
+        committed = []
+        self.manifest = None
+        self.previous_units = {}
+        if units is not None:
+            import hashlib
+            digest = hashlib.sha1()  # in pieces, without an encoded copy of the whole document
+            for k in range(0, len(self.txt), 2 ** 20): digest.update(self.txt[k:k + 2 ** 20].encode("utf-8"))
+            header = {"input": digest.hexdigest(), "language": self.language,
+                      "tag": self.tag, "vocoder_tag": self.vocoder_tag, "sample_rate": self.sample_rate,
+                      "segment_target": self.segment_target,
+                      # settings that change the audio, e.g. the seeding and joined vocoding of batches
+                      "batch_size": self.batch_size, "pipelined": self.pipelined, "workers": self.num_workers,
+                      "vocoder_chunk_frames": self.vocoder_chunk_frames, "compiled": self.compiled, "quantized": self.quantized}
+            if self.voices: header["voices"] = {language: list(voice[:2]) for language, voice in self.voices.items()}
+            self.manifest = JobManifest(f"{self.out_dir}/{self.out_name}.manifest")
+            available = WavWriter.data_samples(fname)
+            committed = self.manifest.resume_point(header, available)
+            if not committed and self.manifest.edited(header):
+                # unchanged sentences are spliced from the previous output
+                units = list(units)
+                self.previous_units = self.manifest.reusable(units, available)
+                if self.previous_units:
+                    import numpy as np
+                    os.replace(fname, fname + ".prev")
+                    self.previous_audio = np.memmap(fname + ".prev", dtype="<i2", mode="r", offset=HEADER_SIZE)
+            self.manifest.start(header, committed)
+        end = committed[-1]["offset"] + committed[-1]["length"] if committed else 0
+        self.writer = WavWriter(fname, self.sample_rate, resume_samples=end)
+        return committed, units
+
+    def splice_previous(self, i):
+        import numpy as np
+        entry = self.previous_units[i]
+        pcm = np.array(self.previous_audio[entry["offset"]:entry["offset"] + entry["length"]])
+        self.stream_audio(pcm)
+        self.save_tasks.append(self.save_executor.submit(self.save_wav, pcm, [(i, len(pcm))]))
+        self.add_subtitle(i, len(pcm))
+
+    def close_writer(self, complete=False):
+        if not self.writer: return
+        import concurrent.futures
+        concurrent.futures.wait(self.save_tasks)
+        self.save_tasks.clear()
+        self.writer.close()
+        self.writer = None
+        if self.previous_audio is not None:
+            fname = self.previous_audio.filename
+            self.previous_audio = None
+            self.previous_units = {}
+            os.remove(fname)
+        if self.manifest:
+            if complete: self.manifest.complete()
+            else: self.manifest.close()
+            self.manifest = None
+
+    def save_wav(self, wav, units=()):
+        # units are the (index, length) of the sentences in wav, committed to the manifest once the audio is on disk
         try:
-            out_arr = wav.view(-1).cpu().numpy()
-            fname = self.out_dir + "/" + self.out_name + ".wav"
-            import soundfile
-            from soundfile import SoundFile
-            if overwrite:
-                soundfile.write(fname, out_arr, samplerate=self.sample_rate, format="WAV")
-            else:
-                try:
-                    with SoundFile(fname, mode="r+") as wav_file:
-                        wav_file.seek(0, soundfile.SEEK_END)
-                        wav_file.write(out_arr)
-                except Exception as e:
-                    soundfile.write(fname, out_arr, samplerate=self.sample_rate, format="WAV")
-                    self.comm("[conversion-done]", "first")
+            first = not self.job_stats.get("writes")
+            with self.timed("write"):
+                offset = self.writer.samples
+                self.writer.write(wav)
+                if self.manifest and units:
+                    self.writer.flush()
+                    for i, length in units:
+                        self.manifest.commit(i, offset, length, self.units.pop(i))
+                        offset += length
+            self.add_stat("writes")
+            if first: self.comm("[conversion-done]", "first")
             # if self.mlDevice == "cuda":
             #     torch.cuda.empty_cache()
         except Exception as e:
             self.output_err("Write error", e)
 
+    def add_stat(self, key, value=1):
+        # per job in job_stats, and for the lifetime of the converter as a <key>_total counter
+        self.job_stats[key] = self.job_stats.get(key, 0) + value
+        self.metrics.inc(key + "_total", value)
+        self.publish_metrics()
+
+    @contextmanager
+    def timed(self, stage):
+        # adds the time spent in the block to the job's <stage>_seconds
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.job_stats[stage + "_seconds"] = self.job_stats.get(stage + "_seconds", 0) + elapsed
+            self.metrics.observe("stage_seconds", elapsed, stage=stage)
+
+    def timed_iter(self, stage, iterable):
+        # like timed, for the time spent producing the items of a lazy iterable
+        it = iter(iterable)
+        while True:
+            with self.timed(stage):
+                item = next(it, StopIteration)
+            if item is StopIteration: return
+            yield item
+
+    def normalize_sentence(self, t, language=None):
+        with self.timed("normalize"):
+            t = general_preprocess(t)
+            if (language or self.language) == "zh":
+                t = preprocess_cn_text(t)
+                t = replace_with_cn_num(t)
+            return t
+
+    def vocode_batch(self, cs):
+        # the vocoders are fully convolutional, so instead of padding to a common length we join the features
+        # with silence gaps in between and vocode them in one call, then cut the output at the frame boundaries
+        import torch
+        with self.timed("vocoder"):
+            if len(cs) == 1: return [vocode(self.vocoder, cs[0], self.vocoder_chunk_frames, check=self.checkpoint)]
+            silence = torch.full((BATCH_GAP_FRAMES, cs[0].size(1)), min(c.min().item() for c in cs), device=cs[0].device)
+            joined = [cs[0]]
+            for c in cs[1:]: joined += [silence, c]
+            joined = torch.cat(joined)
+            wav = vocode(self.vocoder, joined, self.vocoder_chunk_frames, check=self.checkpoint)
+            hop = len(wav) // len(joined)
+        wavs, offset = [], 0
+        for c in cs:
+            wavs.append(wav[offset * hop:(offset + len(c)) * hop])
+            offset += len(c) + BATCH_GAP_FRAMES
+        return wavs
+
+    def quantized_kinds(self, voice=None):
+        # the models of the voice that run quantized, their features and audio are cached apart from the fp32 ones
+        from quantized import quantized_kinds
+        return quantized_kinds(*(voice[3:5] if voice else (self.text2speech, self.vocoder)))
+
+    def audio_key(self, t, voice=None, quantized=None):
+        # quantized is () for audio of fp32 models other than the voice's, e.g. of the shard workers
+        tag, vocoder_tag, sample_rate = voice[:3] if voice else (self.tag, self.vocoder_tag, self.sample_rate)
+        if quantized is None: quantized = self.quantized_kinds(voice)
+        return ArrayCache.key("audio", t, tag, vocoder_tag, sample_rate, *(f"int8-{kind}" for kind in quantized))
+
+    def cached_audio(self, t, voice=None, quantized=None):
+        # copies of sentences repeated within the job first, then the on-disk cache
+        import torch
+        with self.job_audio_lock:
+            wav = self.job_audio.get((t, voice[0]) if voice else t)
+            if wav is not None and self.job_repeated is None: self.job_audio.move_to_end((t, voice[0]) if voice else t)
+        if wav is not None:
+            self.add_stat("reused")
+            return wav
+        if self.audio_cache:
+            arr = self.audio_cache.get(self.audio_key(t, voice, quantized))
+            if arr is not None: return torch.from_numpy(arr)
+        return None
+
+    def cache_audio(self, t, wav, voice=None, quantized=None):
+        # job_repeated is None when the sentences are segmented lazily, then the most recent ones are kept instead
+        key = (t, voice[0]) if voice else t
+        with self.job_audio_lock:
+            if self.job_repeated is None:
+                self.job_audio[key] = wav
+                self.job_audio_bytes += wav.nelement() * wav.element_size()
+                while self.job_audio_bytes > JOB_AUDIO_BYTES and len(self.job_audio) > 1:
+                    old = self.job_audio.popitem(last=False)[1]
+                    self.job_audio_bytes -= old.nelement() * old.element_size()
+            elif t in self.job_repeated: self.job_audio[key] = wav
+        if self.audio_cache: self.audio_cache.put(self.audio_key(t, voice, quantized), wav.cpu().numpy())
+
+    def mel_key(self, t, voice=None):
+        # the same key as the shard workers' for the fp32 acoustic model
+        quantized = ["int8-acoustic"] if "acoustic" in self.quantized_kinds(voice) else []
+        return ArrayCache.key("mel", voice[0] if voice else self.tag, t, *quantized)
+
+    def acoustic_features(self, t):
+        # the features only depend on the acoustic model, so a vocoder change can reuse them
+        if self.mel_cache:
+            c = load_features(self.mel_cache, self.mel_key(t), self.mlDevice)
+            if c is not None:
+                self.add_stat("mel_hits")
+                return c
+        with self.timed("acoustic"):
+            c = self.text2speech(t)[1]
+        self.add_stat("acoustic_sentences")
+        if self.mel_cache: store_features(self.mel_cache, self.mel_key(t), c)
+        return c
+
+    def synthesize_batch(self, ts, seed=None):
+        # audio of normalized sentences, the ones that aren't cached are synthesized together.
+        # returns the audio and whether anything had to be synthesized
+        import torch
+        wavs = [self.cached_audio(t) for t in ts]
+        todo = list(dict.fromkeys(t for t, wav in zip(ts, wavs) if wav is None))
+        if todo:
+            with self.inference_mode():
+                if seed is not None: torch.manual_seed(seed)
+                cs = [self.acoustic_features(t) for t in todo]
+                if seed is not None: torch.manual_seed(seed)
+                synthesized = dict(zip(todo, self.vocode_batch(cs)))
+            for t, wav in synthesized.items(): self.cache_audio(t, wav)
+            wavs = [synthesized[t] if wav is None else wav for t, wav in zip(ts, wavs)]
+        return wavs, bool(todo)
+
+    def batch_convert(self, ts, seed=None, indices=()):
+        import torch
+        start = time.time()
+        wavs, synthesized = self.synthesize_batch(ts, seed)
+        elapsed = time.time() - start
+        lengths = [len(wav) for wav in wavs]
+        speed = (sum(lengths) / self.sample_rate) / elapsed  # audio seconds per second, the inverse of the RTF
+        self.output_status(f"Speed: {speed:5f}x real time" + (f" (batch of {len(ts)})" if len(ts) > 1 else "")
+                           + ("" if synthesized else " (cached)"))
+        self.add_stat("audio_seconds", sum(lengths) / self.sample_rate)
+        self.add_stat("sentences", len(ts))
+        self.add_stat("synthesis_seconds", elapsed)
+        # one write per batch, sentence boundaries are tracked through the lengths
+        for wav in wavs: self.stream_audio(wav)
+        self.save_tasks.append(self.save_executor.submit(self.save_wav, torch.cat(wavs), list(zip(indices, lengths))))
+        return lengths
+
     def simple_convert(self, t):
+        return self.batch_convert([t])[0]
+
+    def iter_units(self):
+        # sentences are tokenized lazily while the first ones are synthesized already. the source sentences and units
+        # are only kept by index until their subtitle and manifest entry are written, so memory doesn't grow with the job
+        def sources(text, language):
+            for s in iter_sentences(text, language):
+                self.source_sentences[self.source_count] = s
+                self.source_count += 1
+                yield s
+
+        def unit(text, language):
+            self.unit_count += 1
+            self.units[self.unit_count] = text
+            if self.unit_languages is not None: self.unit_languages[self.unit_count] = language
+            return text
+
+        segments = self.language_segments() if self.voices else [(self.language, self.txt)]
+        for language, text in segments:
+            offset = self.source_count
+            if self.segment_target > 0:
+                units = resegment(sources(text, language), self.segment_target, "" if language == "zh" else " ")
+                for t, first, last in self.timed_iter("segment", units):
+                    t = unit(t, language)
+                    self.unit_sources[self.unit_count] = (offset + first, offset + last)
+                    yield t
+            else:
+                for s in self.timed_iter("segment", sources(text, language)): yield unit(s, language)
+
+    def unit_language(self, i):
+        return self.unit_languages.get(i, self.language) if self.unit_languages else self.language
+
+    def part(self, first, last=None):
+        part = first if last is None or last == first else f"{first}-{last}"
+        return f"part {part} out of {self.unit_total}" if self.unit_total else f"part {part}"
+
+    def add_subtitle(self, i, length):
+        # consecutive synthesis units from the same source sentences share one subtitle showing the source text.
+        # every unit passes here once and in order, also when resumed or copied, so this is where progress is reported
+        self.comm("[job-progress]", json.dumps({"id": self.job_id, "done": i, "total": self.unit_total}))
+        src = self.unit_sources.pop(i) if self.unit_sources is not None else (i - 1, i - 1)
+        language = self.unit_language(i)
+        if self.unit_languages: self.unit_languages.pop(i, None)
+        if self.pending_subtitle and self.pending_subtitle[0] == src:
+            self.pending_subtitle[1] += length
+            return
+        self.flush_subtitle()
+        self.pending_subtitle = [src, length, language]
+
+    def flush_subtitle(self):
+        if not self.pending_subtitle: return
+        (first, last), length, language = self.pending_subtitle
+        self.pending_subtitle = None
+        text = ("" if language == "zh" else " ").join(self.source_sentences[k] for k in range(first, last + 1))
+        for k in range(self.sources_flushed, first): self.source_sentences.pop(k, None)  # later units start after them
+        self.sources_flushed = max(self.sources_flushed, first)
+        self.srt_index += 1
+        srt_file, lrc_file = self.subtitle_files
+        srt_file.write(f"{self.srt_index}\n{parse_srt_time(self.srt_time)} --> {parse_srt_time(self.srt_time + length / self.sample_rate)}\n{text}\n\n")
+        lrc_file.write(f"[{parse_lrc_time(self.srt_time)}]{text}\n")
+        self.srt_time += length / self.sample_rate
+
+    def batched_convert(self, items):
+        # items are the (index, sentence) pairs to synthesize in order, batches are formed as they come in
+        sentences = ((i, t, self.normalize_sentence(t)) for i, t in items)
+        for batch in group_sentences(sentences, self.batch_size):
+            first, last = batch[0][0], batch[-1][0]
+            t = batch[0][1]
+            self.output_status(
+                f"Converting {self.part(first, last)}: "
+                f"{t if len(t) < 30 else (t[:30] + f'... ({len(t)})')}", end=" ")
+            # try:
+            lengths = self.batch_convert([t for _, _, t in batch], seed=first, indices=[i for i, _, _ in batch])
+            # except Exception as e:
+                # self.output_status("\nError converting, retrying... " + str(e) + "\n")
+                # l = self.simple_convert(t[:len(t)//2]) + self.simple_convert(t[len(t)//2:])
+
+            for (i, tp, _), l in zip(batch, lengths):
+                self.add_subtitle(i, l)
+
+    def sharded_convert(self, items):
+        # sentences are handed out to worker processes one at a time and come back in order,
+        # each worker seeds per sentence like batched_convert does, so the output doesn't depend on the worker count
         import torch
-        with torch.no_grad():
-            start = time.time()
-            wav, c, *_ = self.text2speech(t)
-            wav = self.vocoder.inference(c)
-        rtf = (len(wav) / self.sample_rate) / (time.time() - start)
-        self.output_status(f"Speed: {rtf:5f}x")
-        # save_wav(wav, count)
-        self.save_tasks.append(self.save_executor.submit(self.save_wav, wav))
-        return len(wav)
-
-    def _convert(self):
+        from sharding import ShardPool
+        config = (self.tag, self.vocoder_tag, self.num_workers, self.threads_per_worker,
+                  MEL_CACHE_DIR if self.mel_cache_size > 0 else None, self.mel_cache_size * 2 ** 20, self.vocoder_chunk_frames)
+        if not self.shard_pool or self.shard_pool.config != config:
+            if self.shard_pool: self.shard_pool.close()
+            self.output_status(f"Starting {self.num_workers} synthesis worker processes...")
+            self.shard_pool = ShardPool(*config)
+        start_time = time.time()
+        sentences = [(i, self.normalize_sentence(t)) for i, t in items]
+        # only sentences that aren't cached go to the workers, the rest are merged back in order
+        # the workers run the fp32 models, so their audio is cached as such
+        cached = {i for i, t in sentences
+                  if t in self.job_audio or (self.audio_cache and self.audio_key(t, quantized=()) in self.audio_cache)}
+        seen = set()
+        todo = []
+        for i, t in sentences:
+            if i in cached: continue
+            if t in self.job_repeated:
+                if t in seen:
+                    cached.add(i)
+                    continue
+                seen.add(t)
+            todo.append((i, t))
+        results = self.shard_pool.synthesize(todo)
+        for i, t in sentences:
+            try:
+                self.checkpoint()  # waits here while the job is paused
+            except JobCancelled:
+                # the workers would go on with the rest of the job, a new pool is started for the next one
+                self.shard_pool.close()
+                self.shard_pool = None
+                raise
+            tp = self.units[i]
+            wav = self.cached_audio(t, quantized=()) if i in cached else None
+            if wav is None:
+                if i in cached:  # evicted in the meantime
+                    wav = synthesize(self.text2speech, self.vocoder, t, seed=i, mel_cache=self.mel_cache, mel_key=self.mel_key(t),
+                                     chunk_frames=self.vocoder_chunk_frames, check=self.checkpoint)
+                    self.cache_audio(t, wav)
+                else:
+                    wav = torch.from_numpy(next(results)[1])
+                    self.cache_audio(t, wav, quantized=())
+            self.output_status(f"Converted {self.part(i)}: "
+                               f"{tp if len(tp) < 30 else (tp[:30] + f'... ({len(tp)})')}")
+            self.stream_audio(wav)
+            self.save_tasks.append(self.save_executor.submit(self.save_wav, wav, [(i, len(wav))]))
+            self.add_subtitle(i, len(wav))
+            self.add_stat("audio_seconds", len(wav) / self.sample_rate)
+            self.add_stat("sentences")
+        self.add_stat("synthesis_seconds", time.time() - start_time)
+
+    def pipeline_convert(self, items):
+        # normalization -> acoustic model -> vocoder -> writer, each stage in its own thread,
+        # so the spectrogram of the next sentence is generated while the current one is being vocoded
+        import concurrent.futures
+        from pipeline import Pipeline
+        concurrent.futures.wait(self.save_tasks)  # the writer stage writes directly, after anything spliced before it
+
+        def normalize(item):
+            i, tp = item
+            t = self.normalize_sentence(tp)
+            return i, tp, t, self.cached_audio(t)
+
+        def acoustic(item):
+            i, tp, t, wav = item
+            if wav is not None: return i, tp, t, None, wav
+            with self.inference_mode():  # grad mode is thread local
+                return i, tp, t, self.acoustic_features(t), None
+
+        def vocoder(item):
+            i, tp, t, c, wav = item
+            if wav is not None: return i, tp, wav
+            with self.inference_mode(), self.timed("vocoder"):
+                wav = vocode(self.vocoder, c, self.vocoder_chunk_frames, check=self.checkpoint)
+            self.cache_audio(t, wav)
+            return i, tp, wav
+
+        def write(item):
+            i, tp, wav = item
+            self.stream_audio(wav)
+            self.save_wav(wav, [(i, len(wav))])
+            self.add_subtitle(i, len(wav))
+            self.add_stat("audio_seconds", len(wav) / self.sample_rate)
+            self.add_stat("sentences")
+            self.output_status(f"Converted {self.part(i)}: "
+                               f"{tp if len(tp) < 30 else (tp[:30] + f'... ({len(tp)})')}")
+
+        pipeline = self.pipeline = Pipeline([("normalize", normalize), ("acoustic", acoustic), ("vocoder", vocoder), ("writer", write)],
+                                            max_queue=self.pipeline_queue_size)
+        try:
+            pipeline.run(items)
+        finally:
+            self.pipeline = None
+        self.add_stat("synthesis_seconds", pipeline.wall)
+        self.output_status("Pipeline stages:\n" + "\n".join(pipeline.report()))
+        self.output_status(f"Bottleneck stage: {pipeline.bottleneck().name}")
+
+    def mixed_convert(self, items):
+        # every language has its own models and synthesis thread, so both models run at the same time.
+        # a window of units is kept in flight, the audio is resampled to the job's sample rate and written in order
+        from collections import deque
+        executors = {language: ThreadPoolExecutor(max_workers=1) for language in self.voices}
+        start = time.time()
+
+        def synthesize_unit(i, t, language):
+            self.checkpoint()  # units already submitted when the job is cancelled
+            voice = self.voices[language]
+            t = self.normalize_sentence(t, language)
+            wav = self.cached_audio(t, voice)
+            if wav is None:
+                # no per-sentence seed, both threads share torch's global generator
+                wav = synthesize(voice[3], voice[4], t, mel_cache=self.mel_cache, mel_key=self.mel_key(t, voice),
+                                 chunk_frames=self.vocoder_chunk_frames, check=self.checkpoint)
+                self.cache_audio(t, wav, voice)
+            return self.resample(wav, voice[2])
+
+        def write(i, tp, future):
+            wav = future.result()
+            self.output_status(f"Converted {self.part(i)} ({self.unit_language(i)}): "
+                               f"{tp if len(tp) < 30 else (tp[:30] + f'... ({len(tp)})')}")
+            self.stream_audio(wav)
+            self.save_tasks.append(self.save_executor.submit(self.save_wav, wav, [(i, len(wav))]))
+            self.add_subtitle(i, len(wav))
+            self.add_stat("audio_seconds", len(wav) / self.sample_rate)
+            self.add_stat("sentences")
+
+        pending = deque()
+        try:
+            for i, t in items:
+                pending.append((i, t, executors[self.unit_language(i)].submit(synthesize_unit, i, t, self.unit_language(i))))
+                if len(pending) > MIXED_WINDOW: write(*pending.popleft())
+            while pending: write(*pending.popleft())
+        finally:
+            for executor in executors.values(): executor.shutdown()
+        self.add_stat("synthesis_seconds", time.time() - start)
+
+    def _convert(self, job_id=None):
         try:
             from unicodedata import normalize
+            if not job_id or job_id != self.job_id:  # jobs from the queue are reset when they're taken, see run_next_job
+                self.cancel_event.clear()
+                self.resume_event.set()
+            self.job_id = job_id or uuid.uuid4().hex[:8]
+            self.stream_seq = 0
+            self.job_stats = {"job_start": time.time(), "peak_rss_before": peak_rss()}
+            self.metrics.inc("jobs_total")
+            self.job_audio = OrderedDict()
+            self.job_audio_bytes = 0
+            self.job_repeated = None
+            self.subtitle_files = None
+            self.srt_time = 0
+            self.srt_index = 0
+            self.pending_subtitle = None
             self.pre_convert()
             txt = self.txt
             if len(txt) <= 30:
                 txt = normalize('NFKC', txt)
                 if self.language == 'zh':
                     txt = preprocess_cn_text(txt)
+                self.open_output()
                 self.simple_convert(txt)
             else:
-                import re
-                txt = txt.replace("\n", " ")
-                if self.language == 'zh':
-                    # txt = txt.replace(" ", "").replace("　", "")
-                    txt = re.sub("\\s+", "", txt)
-                    sentence_list = cn_sent_tokenize(txt)
-                else:
-                    from nltk import tokenize
-                    sentence_list = tokenize.sent_tokenize(txt)
-
                 # heavy dependency, might be more accurate, also supports more languages
                 # import stanza
                 # nlp = None
@@ -338,58 +1073,237 @@ class Converter:
 
                 # if not os.path.exists(MODEL_DIR + "/tmp"): os.mkdir(MODEL_DIR + "/tmp")
 
-                srt = ""
-                lrc = ""
-                srt_time = 0
-
-                for i, t in enumerate(sentence_list, 1):
-                    tp = t
-                    self.output_status(
-                        f"Converting part {i} out of {len(sentence_list)}: "
-                        f"{t if len(t) < 30 else (t[:30] + f'... ({len(t)})')}", end=" ")
-                    t = general_preprocess(t)
-                    if self.language == "zh":
-                        t = preprocess_cn_text(t)
-                        t = replace_with_cn_num(t)
-                    # try:
-                    l = self.simple_convert(t)
-                    # except Exception as e:
-                        # self.output_status("\nError converting, retrying... " + str(e) + "\n")
-                        # l = self.simple_convert(t[:len(t)//2]) + self.simple_convert(t[len(t)//2:])
-
-                    srt += f"{i}\n{parse_srt_time(srt_time)} --> {parse_srt_time(srt_time + l / self.sample_rate)}\n{tp}\n\n"
-                    lrc += f"[{parse_lrc_time(srt_time)}]{tp}\n"
-                    srt_time += l / self.sample_rate
-                self.output_status("Generating subtitles/lyrics file...")
-                with open(f"{self.out_dir}/{self.out_name}.srt", encoding="utf-8", mode="w") as srt_file:
-                    srt_file.write(srt)
-                with open(f"{self.out_dir}/{self.out_name}.lrc", encoding="utf-8", mode="w") as lrc_file:
-                    lrc_file.write(lrc)
-                import concurrent.futures
-                concurrent.futures.wait(self.save_tasks)
-                self.save_tasks.clear()
+                self.source_sentences = {}
+                self.source_count = 0
+                self.sources_flushed = 0
+                self.unit_sources = {} if self.segment_target > 0 else None
+                self.units = {}
+                self.unit_count = 0
+                self.setup_voices()
+                committed, units = self.open_output(self.iter_units())
+                # the subtitles are written as the units are, see flush_subtitle
+                self.subtitle_files = tuple(open(f"{self.out_dir}/{self.out_name}.{ext}", encoding="utf-8", mode="w")
+                                            for ext in ("srt", "lrc"))
+                if self.num_workers > 1 and not self.voices: units = list(units)  # the workers get all sentences that aren't cached up front
+                self.unit_total = len(units) if isinstance(units, list) else None
+                items = self.checked(enumerate(units, 1))
+                if committed:
+                    self.output_status(f"Resuming interrupted conversion from {self.part(len(committed) + 1)}")
+                    for entry, _ in zip(committed, items):
+                        self.units.pop(entry["i"], None)  # already in the manifest
+                        self.add_subtitle(entry["i"], entry["length"])
+                # repeated sentences are only synthesized once per job. when the sentences are known up front only the
+                # repeated ones are kept, otherwise the audio of the most recent ones, see cache_audio
+                if isinstance(units, list):
+                    self.job_repeated = {self.normalize_sentence(t) for t, n in Counter(units).items() if n > 1}
+
+                self.job_stats["start"] = time.time()
+                if self.voices:
+                    convert, mode = self.mixed_convert, "mixed languages"
+                    ignored = [name for name, used in (("workers", self.num_workers > 1), ("pipeline", self.pipelined),
+                                                       ("batch size", self.batch_size > 1)) if used]
+                    if ignored:
+                        self.output_status(f"Mixed languages are read one sentence at a time per language, "
+                                           f"ignoring the {', '.join(ignored)} setting{'s' if len(ignored) > 1 else ''}")
+                elif self.num_workers > 1:
+                    convert, mode = self.sharded_convert, f"{self.num_workers} workers"
+                elif self.pipelined:
+                    convert, mode = self.pipeline_convert, "pipelined"
+                else:
+                    convert, mode = self.batched_convert, f"batch size {self.batch_size}"
+                if self.previous_units:
+                    # runs of new or edited sentences are synthesized, unchanged ones in between are copied from the previous output
+                    run = []
+                    for i, t in items:
+                        if i not in self.previous_units:
+                            run.append((i, t))
+                            continue
+                        if run: convert(run)
+                        run = []
+                        self.splice_previous(i)
+                    if run: convert(run)
+                    self.output_status(f"Reused {len(self.previous_units)} of {self.unit_count} sentences from the previous output")
+                else:
+                    convert(items)
+                if self.unit_sources is not None:
+                    self.output_status(f"Resegmented {self.source_count} sentences into {self.unit_count} synthesis units")
+                self.output_status(f"Throughput ({mode}): "
+                                   f"{self.job_stats.get('audio_seconds', 0) / (time.time() - self.job_stats['start']):5f} audio seconds per second")
+                if self.audio_cache or self.job_stats.get("reused"):
+                    self.output_status(f"Audio cache: {self.audio_cache.stats() if self.audio_cache else 'disabled'}, "
+                                       f"{self.job_stats.get('reused', 0)} repeated sentences reused")
+                if self.mel_cache:
+                    hits, sentences = self.job_stats.get("mel_hits", 0), self.job_stats.get("acoustic_sentences", 0)
+                    acoustic = self.job_stats.get("acoustic_seconds", 0)
+                    self.output_status(f"Mel cache: {hits} hits this job, acoustic model ran {acoustic:.2f}s for {sentences} sentences"
+                                       + (f", about {hits * acoustic / sentences:.2f}s saved" if hits and sentences else ""))
+                self.job_audio.clear()
+                self.job_audio_bytes = 0
+                self.write_subtitles()
+            self.close_writer(complete=True)
+            if self.job_stats.get("writes"):
+                self.output_status(f"Write: {self.job_stats['write_seconds'] / self.job_stats['writes'] * 1000:.3f}ms per segment "
+                                   f"({self.job_stats['writes']} segments)")
+            self.job_stats["peak_rss"] = peak_rss()
+            if self.job_stats["peak_rss"]:
+                self.metrics.set("peak_rss_bytes", self.job_stats["peak_rss"])
+                self.output_status(f"Peak memory: {self.job_stats['peak_rss'] / 2 ** 20:.0f}MB "
+                                   f"({self.job_stats['peak_rss_before'] / 2 ** 20:.0f}MB before this job)")
+            self.end_stream()
+            self.metrics.observe("job_seconds", time.time() - self.job_stats["job_start"])
+            if "ttfa" in self.job_stats: self.metrics.observe("ttfa_seconds", self.job_stats["ttfa"])
+            self.publish_metrics(force=True)
             self.comm("[conversion-done]")
             self.output_status("[DONE]" + ("Conversion done! Saved at " if sys_lang == "en" else "转换完毕！结果保存在") + os.path.abspath(f"{self.out_dir}/{self.out_name}.wav"))
+        except JobCancelled:
+            # everything written so far is kept as a valid, shorter output. the manifest isn't completed,
+            # so converting the same text again continues where this job stopped
+            self.job_stats["cancelled"] = True
+            self.close_writer()
+            self.write_subtitles()
+            self.metrics.inc("jobs_cancelled_total")
+            self.publish_metrics(force=True)
+            self.end_stream()
+            self.comm("[conversion-done]")
+            self.output_status("Conversion cancelled, the part converted so far is saved at "
+                               + os.path.abspath(f"{self.out_dir}/{self.out_name}.wav"))
         except Exception as e:
+            self.job_stats["error"] = str(e) or type(e).__name__  # e.g. HandledException has no message
+            self.metrics.inc("job_errors_total")
+            self.publish_metrics(force=True)
             self.output_err("Conversion error", e)
+        finally:
+            self.close_writer()
+            self.write_subtitles()
+
+    def write_subtitles(self):
+        # adds the last subtitle and closes the files, the ones before it were written during the job
+        if not self.subtitle_files: return
+        with self.timed("subtitles"):
+            self.flush_subtitle()
+            for f in self.subtitle_files: f.close()
+        self.subtitle_files = None
 
     def output_err(self, err_type, e):
         import traceback
         self.output_status(f"\n[ERROR]\n----------------------------------------\n{err_type}: " + str(e) + f"\n{''.join(traceback.format_exception(type(e),e, e.__traceback__))}----------------------------------------\n[END OF ERROR]")
 
 
-    def convert(self, background=True):
-        if background: self.convert_executor.submit(self._convert)
-        else: self._convert()
+    def profiled_convert(self, job_id=None):
+        # one job under cProfile and the torch profiler. both only see the conversion thread: the autograd profiler
+        # of torch 1.7 records ops through thread local callbacks, so the pipeline stage and mixed language threads
+        # are missing from the trace, profile those jobs without [pipeline]. both traces are saved next to the output:
+        # <out_name>.<job_id>.prof for pstats/snakeviz and <out_name>.<job_id>.trace.json for chrome://tracing
+        import cProfile
+        import io
+        import pstats
+        import torch
+        profiler = cProfile.Profile()
+        with torch.autograd.profiler.profile(use_cuda=torch.cuda.is_available()) as torch_profiler:
+            profiler.enable()
+            try:
+                self._convert(job_id)
+            finally:
+                profiler.disable()
+        try:
+            base = f"{self.out_dir}/{self.out_name}.{self.job_id}"
+            profiler.dump_stats(base + ".prof")
+            torch_profiler.export_chrome_trace(base + ".trace.json")
+            summary = io.StringIO()
+            pstats.Stats(profiler, stream=summary).sort_stats("tottime").print_stats(PROFILE_TOP)
+            self.output_status(f"Profile of job {self.job_id}, saved at {os.path.abspath(base)}.prof/.trace.json\n"
+                               + summary.getvalue().strip())
+            self.output_status(torch_profiler.key_averages().table(sort_by="self_cpu_time_total", row_limit=PROFILE_TOP))
+            if self.pipelined or self.voices:
+                self.output_status("The torch ops of the pipeline stage and mixed language synthesis threads aren't in the profile")
+        except Exception as e:
+            self.output_err("Profiling error", e)
+
+    def convert(self, background=True, job_id=None):
+        job = self.profiled_convert if self.profile else self._convert
+        if background: self.convert_executor.submit(job, job_id)
+        else: job(job_id)
+
+    def checkpoint(self):
+        # called between sentences and between vocoder chunks, waits while the job is paused and stops it once it's cancelled
+        while not self.resume_event.wait(0.1):
+            if self.cancel_event.is_set(): break
+        if self.cancel_event.is_set(): raise JobCancelled()
+
+    def checked(self, items):
+        for item in items:
+            self.checkpoint()
+            yield item
+
+    def cancel_job(self, job_id=""):
+        # a waiting job is dropped from the queue, the running one (also if job_id is empty) stops at its next checkpoint
+        if job_id and job_id != self.job_id:
+            if self.jobs.remove(job_id): self.job_status(job_id, "cancelled")
+            return
+        self.output_status("Cancelling conversion...")
+        self.cancel_event.set()
+
+    def pause_job(self, job_id="", paused=True):
+        if job_id and job_id != self.job_id: return
+        if paused: self.resume_event.clear()
+        else: self.resume_event.set()
+        self.output_status("Conversion paused" if paused else "Conversion resumed")
+        if self.job_id: self.job_status(self.job_id, "paused" if paused else "running")
+
+    def submit_job(self, job):
+        # every submitted job queues one run_next_job on the converter's worker,
+        # which takes the most urgent waiting job once the worker is free, not necessarily this one
+        position = self.jobs.push(job)
+        self.job_status(job.id, "queued", position=position)
+        self.convert_executor.submit(self.run_next_job)
+
+    def run_next_job(self):
+        job = self.jobs.pop()
+        if job is None: return
+        # the job is the running one from here on, so it can be cancelled or paused while its text is still being read
+        self.job_id = job.id
+        self.cancel_event.clear()
+        self.resume_event.set()
+        self.job_status(job.id, "running")
+        try:
+            self.out_dir, self.out_name = job.out_dir, job.out_name
+            self.custom_esp, self.custom_vocoder = job.esp_model, job.vocoder_model
+            self.autoDetectLang = not job.lang
+            if job.lang: self.language = job.lang
+            self.setup_model_config()
+            if job.file: self.set_text_from_file(job.file)
+            else: self.set_text(job.text)
+            if not self.txt or self.txt.isspace():
+                return self.job_status(job.id, "failed", error="no text")
+            if self.cancel_event.is_set(): return self.job_status(job.id, "cancelled")
+            self.convert(background=False, job_id=job.id)
+        except Exception as e:  # e.g. a missing file, anything in _convert itself is reported in job_stats
+            self.output_err("Job error", e)
+            return self.job_status(job.id, "failed", error=str(e) or type(e).__name__)
+        if self.job_stats.get("cancelled"):
+            return self.job_status(job.id, "cancelled", output=os.path.abspath(f"{self.out_dir}/{self.out_name}.wav"))
+        if "error" in self.job_stats: return self.job_status(job.id, "failed", error=self.job_stats["error"])
+        self.job_status(job.id, "done", output=os.path.abspath(f"{self.out_dir}/{self.out_name}.wav"),
+                        audio_seconds=self.job_stats.get("audio_seconds", 0), seconds=time.time() - self.job_stats["job_start"])
+
+    def job_status(self, job_id, state, **info):
+        # [job-status]|{"id": ..., "state": queued/running/done/failed, ...}
+        self.comm("[job-status]", json.dumps(dict(id=job_id, state=state, **info), ensure_ascii=False))
 
     def __del__(self):
         if self.socket:
             self.socket.close()
+        if self.data_socket:
+            self.data_socket.close()
         if self.convert_executor:
             self.convert_executor.shutdown(wait=False)
             # self.convert_executor._threads.clear()
         if self.save_executor:
             self.save_executor.shutdown(wait=False)
+        if self.shard_pool:
+            self.shard_pool.close()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
         #     self.save_executor._threads.clear()
         # from concurrent.futures import thread
         # concurrent.futures.thread._threads_queues.clear()
@@ -412,33 +1326,87 @@ class ConverterController:
             msg = socket.recv_string()
             cmd, data = msg.split("|", maxsplit=1)
             # print("Got ui msg:", cmd, data)
-            if cmd == "[convert]":
-                if data == "":  # file
-                    self.converter.convert()
-                else:
-                    self.converter.convert_executor.submit(self.converter.set_text, data)
-                    self.converter.convert()
-            elif cmd == "[file]":
-                self.converter.convert_executor.submit(self.converter.set_text_from_file, data)
-            elif cmd == "[lang]":
-                if data:
-                    self.converter.autoDetectLang = False
-                    self.converter.set_language(data)
-                else:
-                    self.converter.autoDetectLang = True
-            elif cmd == "[esp-model]":
-                self.converter.set_custom_model(esp_tag=data)
-            elif cmd == "[vocoder-model]":
-                self.converter.set_custom_model(vocoder_tag=data)
-            elif cmd == "[out-name]":
-                self.converter.out_name = data
-            elif cmd == "[out-dir]":
-                self.converter.out_dir = data
-            elif cmd == "[calibre]":
-                self.converter.force_calibre = data == "1"
-            elif cmd == "[exit]":
-                print("Got exit signal from UI")
-                return
+            try:
+                if cmd == "[job]":
+                    try:
+                        self.converter.submit_job(Job.from_json(data))
+                    except (ValueError, TypeError) as e:
+                        self.converter.output_status(f"[ERROR] invalid job: {e}")
+                elif cmd == "[compiled]":
+                    self.converter.set_compiled(data == "1")
+                elif cmd == "[quantized]":  # 0/1, optionally followed by the allowed distance in dB, e.g. 1,1.5
+                    flag, _, distance = data.partition(",")
+                    self.converter.set_quantized(flag == "1", float(distance) if distance else None)
+                elif cmd == "[torch-threads]":
+                    intra, _, inter = data.partition(",")
+                    threads = max(0, int(intra or 0)), max(0, int(inter or 0))
+                    if threads != (self.converter.intra_op_threads, self.converter.inter_op_threads):
+                        self.converter.intra_op_threads, self.converter.inter_op_threads = threads
+                        self.converter.model_reload_needed = True
+                elif cmd == "[cancel]":
+                    self.converter.cancel_job(data)
+                elif cmd == "[pause]":
+                    self.converter.pause_job(data)
+                elif cmd == "[resume]":
+                    self.converter.pause_job(data, paused=False)
+                elif cmd == "[convert]":
+                    if data == "":  # file
+                        self.converter.convert()
+                    else:
+                        self.converter.convert_executor.submit(self.converter.set_text, data)
+                        self.converter.convert()
+                elif cmd == "[file]":
+                    self.converter.convert_executor.submit(self.converter.set_text_from_file, data)
+                elif cmd == "[lang]":
+                    if data:
+                        self.converter.autoDetectLang = False
+                        self.converter.set_language(data)
+                    else:
+                        self.converter.autoDetectLang = True
+                elif cmd == "[esp-model]":
+                    self.converter.set_custom_model(esp_tag=data)
+                elif cmd == "[vocoder-model]":
+                    self.converter.set_custom_model(vocoder_tag=data)
+                elif cmd == "[out-name]":
+                    self.converter.out_name = data
+                elif cmd == "[out-dir]":
+                    self.converter.out_dir = data
+                elif cmd == "[calibre]":
+                    self.converter.force_calibre = data == "1"
+                elif cmd == "[batch-size]":
+                    self.converter.batch_size = max(1, int(data or 1))
+                elif cmd == "[pipeline]":
+                    self.converter.pipelined = data == "1"
+                elif cmd == "[workers]":
+                    self.converter.num_workers = max(1, int(data or 1))
+                elif cmd == "[audio-cache]":
+                    self.converter.audio_cache_size = max(0, int(data or 0))
+                elif cmd == "[segment-target]":
+                    self.converter.segment_target = max(0, int(data or 0))
+                elif cmd == "[vocoder-chunk]":
+                    self.converter.vocoder_chunk_frames = max(0, int(data or 0))
+                elif cmd == "[mixed-lang]":
+                    self.converter.mixed_language = data == "1"
+                elif cmd == "[stream]":
+                    self.converter.streaming = data == "1"
+                elif cmd == "[model-memory]":
+                    self.converter.model_memory = max(0, int(data or 0))
+                elif cmd == "[mel-cache]":
+                    self.converter.mel_cache_size = max(0, int(data or 0))
+                elif cmd == "[worker-threads]":
+                    self.converter.threads_per_worker = max(0, int(data or 0))
+                elif cmd == "[profile]":
+                    self.converter.profile = data == "1"
+                elif cmd == "[metrics]":
+                    self.converter.publish_metrics(force=True)
+                elif cmd == "[metrics-port]":
+                    self.converter.serve_metrics(max(0, int(data or 0)))
+                elif cmd == "[exit]":
+                    print("Got exit signal from UI")
+                    if self.converter.shard_pool: self.converter.shard_pool.close()  # before the UI terminates this process
+                    return
+            except ValueError as e:  # malformed values from the UI's config, the converter keeps running
+                self.converter.output_status(f"[ERROR] invalid value for {cmd}: {e}")
 
     def __del__(self):
         if self.socket:
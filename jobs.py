@@ -0,0 +1,65 @@
+import heapq
+import itertools
+import json
+import threading
+import uuid
+
+INTERACTIVE_PRIORITY = 0 # conversions started from the UI
+BATCH_PRIORITY = 10 # default, lower values run first
+
+
+class Job:
+    # one conversion with all of its parameters, nothing is taken from whatever the previous job set
+    FIELDS = ("id", "text", "file", "lang", "esp_model", "vocoder_model", "out_dir", "out_name", "priority")
+
+    def __init__(self, id=None, text="", file=None, lang=None, esp_model=None, vocoder_model=None, out_dir=".", out_name=None,
+                 priority=BATCH_PRIORITY):
+        self.id = id or uuid.uuid4().hex[:8]
+        self.text = text
+        self.file = file # read when the job starts, instead of text
+        self.lang = lang # None detects the language
+        self.esp_model = esp_model
+        self.vocoder_model = vocoder_model
+        self.out_dir = out_dir or "."
+        self.out_name = out_name or f"out_{self.id}"
+        self.priority = int(priority)
+
+    @classmethod
+    def from_json(cls, data):
+        params = json.loads(data)
+        if not isinstance(params, dict): raise ValueError("job must be a JSON object")
+        unknown = set(params) - set(cls.FIELDS)
+        if unknown: raise ValueError(f"unknown job parameters: {', '.join(sorted(unknown))}")
+        return cls(**params)
+
+
+class JobQueue:
+    # waiting jobs, by priority and then in submission order
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []
+        self.counter = itertools.count()
+
+    def push(self, job):
+        # returns the job's position, 0 is next
+        with self.lock:
+            entry = (job.priority, next(self.counter), job)
+            heapq.heappush(self.heap, entry)
+            return sorted(self.heap).index(entry)
+
+    def pop(self):
+        with self.lock:
+            return heapq.heappop(self.heap)[2] if self.heap else None
+
+    def remove(self, job_id):
+        # returns the removed job, None if it isn't waiting
+        with self.lock:
+            for entry in self.heap:
+                if entry[2].id == job_id:
+                    self.heap.remove(entry)
+                    heapq.heapify(self.heap)
+                    return entry[2]
+        return None
+
+    def __len__(self):
+        return len(self.heap)
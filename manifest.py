@@ -0,0 +1,83 @@
+import json
+import os
+
+
+class JobManifest:
+    # append-only job log next to the output: one header line describing the job,
+    # then one line per sentence with its text once its audio is safely in the output WAV
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    def read(self):
+        # returns (header, committed entries, complete), header is None if there's no readable manifest
+        header, entries, complete = None, [], False
+        try:
+            with open(self.path, encoding="utf-8", mode="r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # torn last line from a crash
+                    if header is None: header = record
+                    elif record.get("complete"): complete = True
+                    else: entries.append(record)
+        except OSError:
+            pass
+        return header, entries, complete
+
+    def resume_point(self, header, available_samples):
+        # the committed sentences that can be kept: same unfinished job, contiguous from the first one and present in the WAV
+        old_header, entries, complete = self.read()
+        if complete or old_header != header: return []
+        committed = []
+        for n, entry in enumerate(entries, 1):
+            if entry["i"] != n or entry["offset"] + entry["length"] > available_samples: break
+            if committed and entry["offset"] != committed[-1]["offset"] + committed[-1]["length"]: break
+            committed.append(entry)
+        return committed
+
+    def edited(self, header):
+        # whether the previous run used the same models and settings on a different input
+        old_header, _, _ = self.read()
+        return bool(old_header) and old_header.get("input") != header["input"] \
+            and all(old_header.get(k) == v for k, v in header.items() if k != "input")
+
+    def reusable(self, sentences, available_samples):
+        # maps sentence indices of the new job to committed entries of the previous run,
+        # for every sentence the diff against the previous sentences shows as unchanged
+        import difflib
+        _, entries, _ = self.read()
+        entries = [entry for entry in entries if entry["offset"] + entry["length"] <= available_samples]
+        matcher = difflib.SequenceMatcher(None, [entry["t"] for entry in entries], sentences, autojunk=False)
+        reused = {}
+        for a, b, size in matcher.get_matching_blocks():
+            for k in range(size):
+                reused[b + k + 1] = entries[a + k]
+        return reused
+
+    def start(self, header, committed=()):
+        self.f = open(self.path + ".tmp", encoding="utf-8", mode="w")
+        for record in [header, *committed]:
+            self.f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.sync()
+        self.f.close()
+        os.replace(self.path + ".tmp", self.path)
+        self.f = open(self.path, encoding="utf-8", mode="a")
+
+    def commit(self, i, offset, length, t):
+        self.f.write(json.dumps({"i": i, "offset": offset, "length": length, "t": t}, ensure_ascii=False) + "\n")
+        self.sync()
+
+    def complete(self):
+        self.f.write(json.dumps({"complete": True}) + "\n")
+        self.close()
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        if self.f and not self.f.closed:
+            self.sync()
+            self.f.close()
@@ -0,0 +1,111 @@
+import threading
+from bisect import bisect_left
+
+# counters, gauges and histograms of a long-running converter. they're published as [metrics] frames next to the logs
+# and can be scraped from a local HTTP endpoint in the Prometheus text format
+
+PREFIX = "synthesizer_"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)  # seconds
+
+
+def _labels(labels):
+    if not labels: return ""
+    return "{" + ",".join(f'{k}="{str(v)}"' for k, v in sorted(labels.items())) + "}"
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.types = {}  # name -> counter, gauge or histogram, in the order they were first used
+        self.values = {}  # (name, labels) -> value, for histograms [bucket counts, sum, count]
+        self.collectors = []  # called before reading the metrics, to update gauges of things that aren't tracked as they change
+
+    def _key(self, kind, name, labels):
+        self.types.setdefault(name, kind)
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            key = self._key("counter", name, labels)
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[self._key("gauge", name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            key = self._key("histogram", name, labels)
+            if key not in self.values: self.values[key] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+            histogram = self.values[key]
+            histogram[0][bisect_left(BUCKETS, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def add_collector(self, fn):
+        self.collectors.append(fn)
+
+    def collect(self):
+        for fn in self.collectors:
+            try:
+                fn(self)
+            except Exception as e:
+                print("Metrics collector error:", e)
+
+    def samples(self):
+        # (metric name, sample name, labels, value) of every sample, histograms expanded into cumulative buckets, sum and count
+        self.collect()
+        with self.lock:
+            order = {name: n for n, name in enumerate(self.types)}
+            samples = []
+            for (name, labels), value in sorted(self.values.items(), key=lambda item: (order[item[0][0]], item[0][1])):
+                labels = dict(labels)
+                if self.types[name] != "histogram":
+                    samples.append((name, PREFIX + name, labels, value))
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, n in zip(BUCKETS + ("+Inf",), counts):
+                    cumulative += n
+                    samples.append((name, PREFIX + name + "_bucket", dict(labels, le=bound), cumulative))
+                samples.append((name, PREFIX + name + "_sum", labels, total))
+                samples.append((name, PREFIX + name + "_count", labels, count))
+        return samples
+
+    def snapshot(self):
+        # flat {"name{labels}": value}, the payload of [metrics] frames
+        return {sample + _labels(labels): value for _, sample, labels, value in self.samples()}
+
+    def render(self):
+        lines, typed = [], set()
+        for name, sample, labels, value in self.samples():
+            if name not in typed:
+                lines.append(f"# TYPE {PREFIX}{name} {self.types[name]}")
+                typed.add(name)
+            lines.append(f"{sample}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def serve(metrics, port, host="127.0.0.1"):
+    # exposition endpoint on http://host:port/metrics in a daemon thread, returns the server to shut it down
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # scrapes would flood the console
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
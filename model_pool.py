@@ -0,0 +1,59 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+def model_size(*models):
+    # bytes of parameters and buffers, Text2Speech wraps its torch module in .model
+    import torch
+    size = 0
+    for m in models:
+        module = m if isinstance(m, torch.nn.Module) else getattr(m, "model", None)
+        if module is None: continue
+        for t in list(module.parameters()) + list(module.buffers()):
+            size += t.numel() * t.element_size()
+    return size
+
+
+class ModelPool:
+    # keeps several loaded (acoustic model, vocoder) pairs resident, evicting the least recently used above max_bytes
+    def __init__(self, loader, max_bytes, log=print):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.log = log
+        self.lock = threading.Lock()
+        self.models = OrderedDict()  # (tag, vocoder_tag, device) -> (models, size), least recently used first
+
+    def get(self, tag, vocoder_tag, device):
+        key = (tag, vocoder_tag, device)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                self.log(f"Using resident models {tag} + {vocoder_tag} ({device})")
+                return self.models[key][0]
+            start = time.time()
+            models = self.loader(tag, vocoder_tag, device, log=self.log)
+            size = model_size(*models)
+            self.models[key] = (models, size)
+            self.log(f"Loaded models {tag} + {vocoder_tag} ({device}, {size / 2 ** 20:.0f}MB) in {time.time() - start:.1f}s")
+            self.evict()
+            return models
+
+    def size(self):
+        return sum(size for _, size in self.models.values())
+
+    def evict(self):
+        # the most recently used pair always stays, even if it's bigger than the budget on its own
+        evicted = False
+        while len(self.models) > 1 and self.size() > self.max_bytes:
+            (tag, vocoder_tag, device), (_, size) = self.models.popitem(last=False)
+            self.log(f"Evicted models {tag} + {vocoder_tag} ({device}, {size / 2 ** 20:.0f}MB)")
+            evicted = True
+        if evicted:
+            import torch
+            if torch.cuda.is_available(): torch.cuda.empty_cache()
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
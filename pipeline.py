@@ -0,0 +1,85 @@
+import queue
+import threading
+import time
+
+_DONE = object()
+
+
+class Stage:
+    def __init__(self, name, fn, max_queue=4):
+        self.name = name
+        self.fn = fn
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.next = None
+        self.error = None
+        self.busy = 0.0
+        self.items = 0
+        self.depth_total = 0
+        self.depth_max = 0
+        self.puts = 0
+
+    def put(self, item):
+        depth = self.queue.qsize()
+        self.depth_total += depth
+        self.depth_max = max(self.depth_max, depth)
+        self.puts += 1
+        self.queue.put(item)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is _DONE:
+                if self.next: self.next.put(_DONE)
+                return
+            if self.error: continue  # keep draining so upstream stages don't block on a full queue
+            start = time.time()
+            try:
+                result = self.fn(item)
+            except Exception as e:
+                self.error = e
+                continue
+            finally:
+                self.busy += time.time() - start
+            self.items += 1
+            if self.next: self.next.put(result)
+
+    def report(self, wall):
+        avg_depth = self.depth_total / self.puts if self.puts else 0
+        return f"{self.name:>10}: busy {self.busy:.2f}s ({self.busy / wall:.0%}), {self.items} items, " \
+               f"queue depth avg {avg_depth:.1f} max {self.depth_max}"
+
+
+class Pipeline:
+    # each stage runs in its own thread, connected to the next one by a bounded queue
+    def __init__(self, stages, max_queue=4):
+        self.stages = [Stage(name, fn, max_queue) for name, fn in stages]
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next = next_stage
+        self.wall = 0.0
+
+    def run(self, items):
+        start = time.time()
+        threads = [threading.Thread(target=stage.run, daemon=True) for stage in self.stages]
+        for thread in threads: thread.start()
+        head = self.stages[0]
+        try:
+            for item in items:
+                if any(stage.error for stage in self.stages): break
+                head.put(item)
+        except BaseException as e:
+            # e.g. a cancelled job, the stages drop what's still queued
+            for stage in self.stages: stage.error = stage.error or e
+            raise
+        finally:
+            head.put(_DONE)
+            for thread in threads: thread.join()
+            self.wall = time.time() - start
+        for stage in self.stages:
+            if stage.error: raise stage.error
+
+    def bottleneck(self):
+        return max(self.stages, key=lambda stage: stage.busy)
+
+    def report(self):
+        wall = self.wall or 1e-9
+        return [stage.report(wall) for stage in self.stages]
@@ -0,0 +1,153 @@
+import copy
+import os
+import re
+
+import numpy as np
+import torch
+
+# dynamic int8 quantization of the acoustic model and the vocoder for CPU inference. the weights of the linear and
+# recurrent layers are stored as int8, activations are quantized on the fly. conv layers would need static quantization
+# with calibration data, so they stay fp32. each quantized model is checked against its fp32 version on fixed sentences
+# with the log spectral distance of the audio and only used if it's within the allowed distance. quantized models are
+# saved with their distance per model tag and torch version
+
+QUANTIZABLE = {torch.nn.Linear, torch.nn.LSTM, torch.nn.GRU}
+SENTENCES = {
+    "zh": ["你好，欢迎使用语音合成。", "今天的天气非常好，我们一起去公园散步吧。", "二零二一年三月十五日，气温十八摄氏度。"],
+    "en": ["Hello, and welcome.", "The weather is lovely today, so we are going for a walk in the park.",
+           "On March fifteenth, the temperature reached eighteen degrees."],
+}
+
+
+def log_spectral_distance(ref, test, n_fft=1024, hop=256):
+    # in dB: root mean square over frequency of the difference of the log power spectra, averaged over frames.
+    # compared over the shorter length, powers more than 80 dB below the reference's peak count as silence
+    ref, test = np.asarray(ref, dtype=np.float64).reshape(-1), np.asarray(test, dtype=np.float64).reshape(-1)
+    n = max(min(len(ref), len(test)), n_fft)
+    ref, test = np.pad(ref[:n], (0, n - len(ref[:n]))), np.pad(test[:n], (0, n - len(test[:n])))
+    frames = np.arange(n_fft)[None, :] + hop * np.arange(1 + (n - n_fft) // hop)[:, None]
+    window = np.hanning(n_fft)
+    ref_power = np.abs(np.fft.rfft(ref[frames] * window)) ** 2
+    test_power = np.abs(np.fft.rfft(test[frames] * window)) ** 2
+    floor = max(ref_power.max(), 1e-20) * 1e-8
+    diff = 10 * np.log10(np.maximum(ref_power, floor)) - 10 * np.log10(np.maximum(test_power, floor))
+    return float(np.mean(np.sqrt(np.mean(diff ** 2, axis=1))))
+
+
+def artifact_path(directory, tag, kind):
+    return os.path.join(directory, re.sub(r"[^\w.-]", "_", f"{tag}.torch{torch.__version__}.{kind}") + ".pt")
+
+
+def quantize(module):
+    # a quantized copy of the module, None if nothing in it can be quantized
+    if not any(type(m) in QUANTIZABLE for m in module.modules()): return None
+    return torch.quantization.quantize_dynamic(copy.deepcopy(module), QUANTIZABLE, dtype=torch.qint8)
+
+
+def _load(path, log, what):
+    # the saved quantized model with its measured distance, None if there's none or it can't be read
+    if not os.path.exists(path): return None
+    try:
+        checked = torch.load(path, map_location="cpu")
+        if isinstance(checked, dict) and "model" in checked: return checked
+    except Exception as e:
+        log(f"Couldn't load quantized {what}, quantizing it again: {e}")
+    return None
+
+
+class QuantizedTTS(torch.nn.Module):
+    # stands in for the Text2Speech model's tts module, keeps the fp32 one to switch back to
+    def __init__(self, quantized, eager):
+        super().__init__()
+        self.quantized = quantized
+        self.eager = eager
+
+    def inference(self, *args, **kwargs):
+        return self.quantized.inference(*args, **kwargs)
+
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(self._modules["eager"], name)
+
+
+def _audio(text2speech, vocoder, sentences):
+    torch.manual_seed(0)
+    with torch.no_grad():
+        return [vocoder.inference(text2speech(t)[1]).view(-1).cpu().numpy() for t in sentences]
+
+
+def quantize_models(text2speech, vocoder, tag, vocoder_tag, language, directory, max_distance=2.0, log=print):
+    # installs the quantized models that are within max_distance dB of the fp32 ones, returns their distances
+    if torch.backends.quantized.engine not in ("fbgemm", "qnnpack"):  # e.g. on ARM, where only qnnpack is built
+        torch.backends.quantized.engine = "fbgemm" if "fbgemm" in torch.backends.quantized.supported_engines else "qnnpack"
+    try:
+        return _install(text2speech, vocoder, tag, vocoder_tag, SENTENCES.get(language, SENTENCES["en"]),
+                        directory, max_distance, log)
+    except Exception:
+        restore_models(text2speech, vocoder)
+        raise
+
+
+def _install(text2speech, vocoder, tag, vocoder_tag, sentences, directory, max_distance, log):
+    # each model is checked with the other one in fp32, the quantized model and its distance are saved together,
+    # so later startups skip quantizing and the check
+    tts = text2speech.model.tts
+    models = [("vocoder", vocoder_tag, vocoder, lambda q: _install_vocoder(vocoder, q), lambda: _restore_vocoder(vocoder)),
+              ("acoustic", tag, tts, lambda q: setattr(text2speech.model, "tts", QuantizedTTS(q, tts)),
+               lambda: setattr(text2speech.model, "tts", tts))]
+    reference, checked = None, {}
+    for kind, model_tag, module, install, restore in models:
+        path = artifact_path(directory, model_tag, kind)
+        checked[kind] = _load(path, log, f"{kind} {model_tag}")
+        if checked[kind] is not None: continue
+        quantized = quantize(module)
+        if quantized is None:
+            log(f"{kind.capitalize()} {model_tag} has no layers dynamic quantization can handle, keeping it fp32")
+            continue
+        if reference is None: reference = _audio(text2speech, vocoder, sentences)
+        install(quantized)
+        try:
+            # the acoustic model can change the durations too, so the audio is compared over the shorter length
+            audio = _audio(text2speech, vocoder, sentences)
+        finally:
+            restore()
+        distance = np.mean([log_spectral_distance(r, q) for r, q in zip(reference, audio)])
+        checked[kind] = {"model": quantized, "distance": float(distance),
+                         "length_change": sum(map(len, audio)) / sum(map(len, reference)) - 1}
+        os.makedirs(directory, exist_ok=True)
+        torch.save(checked[kind], path)
+
+    distances = {}
+    for kind, _, _, install, _ in models:
+        if checked[kind] is None: continue
+        distances[kind] = checked[kind]["distance"]
+        if distances[kind] <= max_distance: install(checked[kind]["model"])
+        log(f"Quantized {kind}: {distances[kind]:.2f} dB log spectral distance to fp32, "
+            f"{checked[kind]['length_change']:+.1%} audio length, "
+            + ("using it" if distances[kind] <= max_distance else f"above the {max_distance} dB allowed, keeping fp32"))
+    return distances
+
+
+def _install_vocoder(vocoder, quantized):
+    # the marker tells it apart from a traced inference, see compiled.py
+    vocoder.__dict__.update(inference=quantized.inference, quantized_inference=True)
+
+
+def _restore_vocoder(vocoder):
+    vocoder.__dict__.pop("inference", None)
+    vocoder.__dict__.pop("quantized_inference", None)
+
+
+def restore_models(text2speech, vocoder):
+    # back to the fp32 models
+    if isinstance(text2speech.model.tts, QuantizedTTS): text2speech.model.tts = text2speech.model.tts.eager
+    _restore_vocoder(vocoder)
+
+
+def quantized_kinds(text2speech, vocoder):
+    # the models that run quantized right now, e.g. the stub models never do
+    return tuple(kind for kind, quantized in
+                 (("acoustic", isinstance(getattr(getattr(text2speech, "model", None), "tts", None), QuantizedTTS)),
+                  ("vocoder", "quantized_inference" in getattr(vocoder, "__dict__", {}))) if quantized)
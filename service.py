@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# Local HTTP synthesis service, e.g.:
+#   python service.py --lang zh --port 8300
+#   curl --data-binary @demo_txt_files/cn_short.txt http://127.0.0.1:8300/synthesize -o out.wav
+# POST /synthesize streams back a WAV (text/plain body, or JSON {"text": ...}), sentence by sentence as they're synthesized.
+# sentences of all requests in flight are collected into shared model batches for up to --window-ms.
+# GET /stats has the p50/p99 latencies as JSON, GET /metrics the converter's metrics
+import argparse
+import asyncio
+import json
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from converter import AUDIO_CACHE_DIR, MEL_CACHE_DIR, Converter, load_models
+from util import iter_sentences
+from wav_writer import to_pcm, wav_header
+
+LATENCY_SAMPLES = 1000 # latencies kept for the percentiles
+MAX_HEADERS = 100 # header lines per request
+
+
+def percentile(values, p):
+    if not values: return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class SynthesisService:
+    def __init__(self, converter, max_batch=8, window=0.02, max_requests=32, max_chars=20000):
+        self.converter = converter
+        self.max_batch = max_batch
+        self.window = window # seconds a batch waits for sentences of other requests after its first one
+        self.max_requests = max_requests
+        self.max_chars = max_chars
+        self.active = 0
+        self.queue = None
+        self.executor = ThreadPoolExecutor(max_workers=1) # the models run on one thread, batching is what makes them busy
+        self.first_audio = deque(maxlen=LATENCY_SAMPLES)
+        self.total = deque(maxlen=LATENCY_SAMPLES)
+        self.rejected = 0
+        self.batches = 0
+        self.batch_sentences = 0
+
+    async def start(self, host="127.0.0.1", port=8300):
+        self.queue = asyncio.Queue()
+        self.batcher_task = asyncio.ensure_future(self.batcher())
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def batcher(self):
+        # (sentence, future) pairs of all requests -> one synthesize_batch call per window
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), max(0, deadline - loop.time())))
+                except asyncio.TimeoutError:
+                    break
+            batch = [(t, future) for t, future in batch if not future.done()] # requests that went away
+            if not batch: continue
+            self.batches += 1
+            self.batch_sentences += len(batch)
+            self.converter.metrics.inc("service_batches_total")
+            try:
+                wavs = await loop.run_in_executor(self.executor, self.synthesize, [t for t, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done(): future.set_exception(e)
+                continue
+            for (_, future), wav in zip(batch, wavs):
+                if not future.done(): future.set_result(wav)
+
+    def synthesize(self, ts):
+        wavs, _ = self.converter.synthesize_batch(ts)
+        return [to_pcm(wav).tobytes() for wav in wavs]
+
+    def sentences(self, text):
+        text = re.sub(r"\n+", "\n\n", text.strip())
+        for s in iter_sentences(text, self.converter.language):
+            t = self.converter.normalize_sentence(s)
+            if t.strip(): yield t
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                method, path, headers, body = await self.read_request(reader)
+                if body is None:
+                    return await self.respond(writer, 413, "text/plain", f"more than {self.max_chars} characters\n".encode())
+                text = body.decode("utf-8")
+                if "json" in headers.get("content-type", ""): text = json.loads(text).get("text", "") if text else ""
+            except (ValueError, UnicodeDecodeError, AttributeError) as e:
+                return await self.respond(writer, 400, "text/plain", f"bad request: {e}\n".encode())
+            if method == "GET" and path == "/stats":
+                await self.respond(writer, 200, "application/json", json.dumps(self.stats()).encode())
+            elif method == "GET" and path == "/metrics":
+                await self.respond(writer, 200, "text/plain; version=0.0.4", self.converter.metrics.render().encode())
+            elif method == "POST" and path == "/synthesize":
+                await self.synthesize_request(writer, text)
+            else:
+                await self.respond(writer, 404, "text/plain", b"not found\n")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            print("Request error:", e)
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        # the body is None if it can't be within max_chars, it's rejected before it's read
+        method, path, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+        headers = {}
+        for _ in range(MAX_HEADERS + 1):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""): break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+        else:
+            raise ValueError(f"more than {MAX_HEADERS} headers")
+        length = int(headers.get("content-length", 0))
+        if length > self.max_chars * 4: return method, path.split("?")[0], headers, None # utf-8 is up to 4 bytes per character
+        return method, path.split("?")[0], headers, await reader.readexactly(length)
+
+    @staticmethod
+    async def respond(writer, status, content_type, body, extra=""):
+        reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large", 503: "Service Unavailable"}[status]
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                     f"{extra}Connection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+
+    async def synthesize_request(self, writer, text):
+        # admission control first: a bounded number of requests in flight and of characters per request
+        if len(text) > self.max_chars:
+            return await self.respond(writer, 413, "text/plain", f"more than {self.max_chars} characters\n".encode())
+        if self.active >= self.max_requests:
+            self.rejected += 1
+            self.converter.metrics.inc("service_rejected_total")
+            return await self.respond(writer, 503, "text/plain", b"busy, retry later\n", "Retry-After: 1\r\n")
+        self.active += 1
+        start = time.perf_counter()
+        loop = asyncio.get_event_loop()
+        pending = deque()
+        try:
+            sentences = self.sentences(text)
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: audio/wav\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+            self.write_chunk(writer, wav_header(self.converter.sample_rate, 0xFFFFFFFF)) # size unknown until the end
+            first = True
+            while True:
+                # up to max_batch sentences of the request are queued at a time, so long requests don't starve short ones
+                while len(pending) < self.max_batch:
+                    t = next(sentences, None)
+                    if t is None: break
+                    future = loop.create_future()
+                    pending.append(future)
+                    self.queue.put_nowait((t, future))
+                if not pending: break
+                self.write_chunk(writer, await pending.popleft())
+                await writer.drain()
+                if first:
+                    self.first_audio.append(time.perf_counter() - start)
+                    first = False
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+            self.total.append(time.perf_counter() - start)
+            self.converter.metrics.observe("service_request_seconds", time.perf_counter() - start)
+        finally:
+            for future in pending: future.cancel()
+            self.active -= 1
+
+    @staticmethod
+    def write_chunk(writer, data):
+        if data: writer.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+
+    def stats(self):
+        return {"active": self.active, "queued": self.queue.qsize(), "rejected": self.rejected, "requests": len(self.total),
+                "batches": self.batches, "avg_batch": self.batch_sentences / self.batches if self.batches else None,
+                "first_audio_p50": percentile(self.first_audio, 50), "first_audio_p99": percentile(self.first_audio, 99),
+                "total_p50": percentile(self.total, 50), "total_p99": percentile(self.total, 99)}
+
+
+def create_service(lang="zh", loader=load_models, **kwargs):
+    converter = Converter(lang=lang, background=False, loader=loader, publish=False, print_log=False)
+    converter.autoDetectLang = False
+    converter.audio_cache = converter.setup_cache(None, AUDIO_CACHE_DIR, converter.audio_cache_size)
+    converter.mel_cache = converter.setup_cache(None, MEL_CACHE_DIR, converter.mel_cache_size)
+    return SynthesisService(converter, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local HTTP speech synthesis service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8300)
+    parser.add_argument("--lang", default="zh")
+    parser.add_argument("--max-batch", type=int, default=8, help="sentences per model batch")
+    parser.add_argument("--window-ms", type=float, default=20, help="how long a batch waits for more sentences")
+    parser.add_argument("--max-requests", type=int, default=32, help="requests in flight before new ones are rejected")
+    parser.add_argument("--max-chars", type=int, default=20000, help="characters per request")
+    parser.add_argument("--stub", action="store_true", help="deterministic stub models instead of the real ones")
+    args = parser.parse_args()
+    loader = load_models
+    if args.stub:
+        from stub_models import stub_loader
+        loader = stub_loader()
+    service = create_service(args.lang, loader, max_batch=args.max_batch, window=args.window_ms / 1000,
+                             max_requests=args.max_requests, max_chars=args.max_chars)
+    loop = asyncio.get_event_loop()
+    server = loop.run_until_complete(service.start(args.host, args.port))
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        loop.run_until_complete(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("Latencies:", json.dumps(service.stats()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import multiprocessing
+import os
+import threading
+import time
+
+_models = None
+_mel_cache = None
+_tag = None
+_chunk_frames = 0
+
+
+def _exit_with_parent(parent):
+    # a converter that was killed never closes the pool, its workers would wait for tasks forever
+    while os.getppid() == parent: time.sleep(1)
+    os._exit(0)
+
+
+def _init_worker(tag, vocoder_tag, threads, mel_cache_dir, mel_cache_bytes, chunk_frames, parent):
+    global _models, _mel_cache, _tag, _chunk_frames
+    threading.Thread(target=_exit_with_parent, args=(parent,), daemon=True).start()
+    import torch
+    torch.set_num_threads(threads)
+    from converter import load_models
+    _models = load_models(tag, vocoder_tag, "cpu", log=lambda msg, end="\n": None)
+    _tag = tag
+    _chunk_frames = chunk_frames
+    if mel_cache_dir:
+        from cache import ArrayCache
+        _mel_cache = ArrayCache(mel_cache_dir, mel_cache_bytes)
+
+
+def _synthesize(item):
+    from cache import ArrayCache
+    from converter import synthesize
+    i, t = item
+    text2speech, vocoder = _models
+    wav = synthesize(text2speech, vocoder, t, seed=i, mel_cache=_mel_cache, mel_key=ArrayCache.key("mel", _tag, t),
+                     chunk_frames=_chunk_frames)
+    return i, wav.cpu().numpy()
+
+
+class ShardPool:
+    # worker processes that each hold their own copy of the models
+    def __init__(self, tag, vocoder_tag, workers, threads=0, mel_cache_dir=None, mel_cache_bytes=0, chunk_frames=0):
+        self.config = (tag, vocoder_tag, workers, threads, mel_cache_dir, mel_cache_bytes, chunk_frames)
+        if not threads: threads = max(1, (os.cpu_count() or 1) // workers)
+        # spawn instead of fork, forking a process that already runs torch threads and zmq sockets isn't safe
+        ctx = multiprocessing.get_context("spawn")
+        self.pool = ctx.Pool(workers, initializer=_init_worker,
+                             initargs=(tag, vocoder_tag, threads, mel_cache_dir, mel_cache_bytes, chunk_frames, os.getpid()))
+
+    def synthesize(self, sentences):
+        # yields (index, wav) in the order the sentences were given
+        return self.pool.imap(_synthesize, sentences)
+
+    def close(self):
+        self.pool.terminate()
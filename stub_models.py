@@ -0,0 +1,52 @@
+import zlib
+
+# deterministic stand-ins for the espnet acoustic model and the parallel_wavegan vocoder, so the converter can be
+# benchmarked offline on CPU. cost is the number of extra layers each model runs, to simulate heavier models
+
+MEL_DIM = 80
+HOP = 300  # samples per frame, same as the csmsc and ljspeech vocoders
+
+
+class StubText2Speech:
+    # a few frames per character, the values only depend on the text
+    def __init__(self, device="cpu", cost=1, frames_per_char=8):
+        import torch
+        self.device = device
+        self.cost = cost
+        self.frames_per_char = frames_per_char
+        self.weight = (torch.eye(MEL_DIM) * 0.9 + 0.1 / MEL_DIM).to(device)
+        self.model = None  # nothing for the model pool to count
+
+    def __call__(self, text):
+        import torch
+        generator = torch.Generator().manual_seed(zlib.crc32(text.encode("utf-8")))
+        c = torch.rand(max(len(text), 1) * self.frames_per_char, MEL_DIM, generator=generator).to(self.device)
+        for _ in range(self.cost):
+            c = torch.tanh(c @ self.weight)
+        return None, c * 4 - 4, None  # (wav, features, ...) like Text2Speech, features in the usual log mel range
+
+
+class StubVocoder:
+    # HOP samples per frame, so chunked and batched vocoding cut the output at the same places as with a real vocoder
+    def __init__(self, device="cpu", cost=1, hop=HOP):
+        import torch
+        self.cost = cost
+        self.hop = hop
+        self.weight = (torch.full((MEL_DIM, MEL_DIM, 3), 1 / (3 * MEL_DIM))).to(device)
+
+    def inference(self, c):
+        import torch
+        import torch.nn.functional as F
+        x = c.t().unsqueeze(0)
+        for _ in range(self.cost):
+            x = torch.tanh(F.conv1d(x, self.weight, padding=1))
+        wav = F.interpolate(x.mean(1, keepdim=True), scale_factor=self.hop, mode="linear", align_corners=False)
+        return (wav * 0.5).view(-1, 1)
+
+
+def stub_loader(acoustic_cost=1, vocoder_cost=1):
+    # a drop-in for converter.load_models
+    def load(tag, vocoder_tag, device, log=print):
+        log(f"Using stub models in place of {tag} + {vocoder_tag}")
+        return StubText2Speech(device, acoustic_cost), StubVocoder(device, vocoder_cost)
+    return load
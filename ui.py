@@ -1,10 +1,12 @@
 import multiprocessing
 from multiprocessing import Process
 
+import json
 import locale
 import multiprocessing
 import os
 import sys
+import uuid
 from multiprocessing import Process
 from threading import Thread
 
@@ -16,6 +18,7 @@ from PySide2.QtWidgets import QApplication, QMainWindow, QTextEdit, QGridLayout,
     QPushButton, QComboBox, QVBoxLayout, QFileDialog, QMessageBox, QCheckBox
 
 from converter import ConverterController
+from jobs import INTERACTIVE_PRIORITY
 
 sys_lang = locale.getdefaultlocale()[0]
 if "en" in sys_lang: sys_lang = "en"
@@ -94,6 +97,8 @@ class Main(QMainWindow):
                 self.new_download.emit(data)
             elif cmd == "[conversion-done]":
                 self.conversion_status.emit()
+            elif cmd in ("[metrics]", "[job-status]", "[job-progress]"):
+                continue  # for monitoring and other clients, the log shows the same
             elif cmd == "[crash]":
                 self.emit_log(f"Converter crashed, exiting... ({data})")
             else:
@@ -144,11 +149,31 @@ class Main(QMainWindow):
 
     def start_convert(self):
         print("Starting conversion...")
-        self.msg_sender("[lang]", self.language_dropdown.currentData())
-        self.msg_sender("[esp-model]", self.esp_model_dropdown.currentData())
-        self.msg_sender("[vocoder-model]", self.vocoder_model_dropdown.currentData())
         # self.msg_sender("[calibre]", "1" if self.calibre_checkbox.isChecked() else "0")
-        self.msg_sender("[convert]", ("" if self.from_file else self.text_input.toPlainText()))
+        self.msg_sender("[batch-size]", self.cfg.get("main", "batch_size", fallback="1"))
+        self.msg_sender("[pipeline]", "1" if self.cfg.get("main", "pipeline", fallback="False") == "True" else "0")
+        self.msg_sender("[workers]", self.cfg.get("main", "workers", fallback="1"))
+        self.msg_sender("[worker-threads]", self.cfg.get("main", "worker_threads", fallback="0"))
+        self.msg_sender("[audio-cache]", self.cfg.get("main", "audio_cache_mb", fallback="1024"))
+        self.msg_sender("[mel-cache]", self.cfg.get("main", "mel_cache_mb", fallback="1024"))
+        self.msg_sender("[model-memory]", self.cfg.get("main", "model_memory_mb", fallback="2048"))
+        self.msg_sender("[segment-target]", self.cfg.get("main", "segment_target", fallback="0"))
+        self.msg_sender("[vocoder-chunk]", self.cfg.get("main", "vocoder_chunk_frames", fallback="1000"))
+        self.msg_sender("[stream]", "1" if self.cfg.get("main", "stream", fallback="False") == "True" else "0")
+        self.msg_sender("[mixed-lang]", "1" if self.cfg.get("main", "mixed_language", fallback="True") == "True" else "0")
+        self.msg_sender("[compiled]", "1" if self.cfg.get("main", "compiled", fallback="False") == "True" else "0")
+        self.msg_sender("[quantized]", ("1" if self.cfg.get("main", "quantized", fallback="False") == "True" else "0")
+                        + "," + self.cfg.get("main", "quantized_max_distance", fallback="2.0"))
+        self.msg_sender("[torch-threads]", self.cfg.get("main", "torch_threads", fallback="0,0"))
+        self.msg_sender("[profile]", "1" if self.cfg.get("main", "profile", fallback="False") == "True" else "0")
+        self.msg_sender("[metrics-port]", self.cfg.get("main", "metrics_port", fallback="0"))
+        # the text box has the file's content too, so the job doesn't depend on what the converter read last
+        self.job_id = uuid.uuid4().hex[:8]
+        self.msg_sender("[job]", json.dumps({"id": self.job_id, "text": self.text_input.toPlainText(), "lang": self.language_dropdown.currentData() or None,
+                                             "esp_model": self.esp_model_dropdown.currentData() or None,
+                                             "vocoder_model": self.vocoder_model_dropdown.currentData() or None,
+                                             "out_dir": self.cfg.get("main", "out_dir", fallback="") or ".", "out_name": "out",
+                                             "priority": INTERACTIVE_PRIORITY}))
         self.cfg.set('main', 'lang', str(self.language_dropdown.currentIndex()))
         self.cfg.set('main', 'esp', str(self.esp_model_dropdown.currentIndex()))
         self.cfg.set('main', 'vocoder', str(self.vocoder_model_dropdown.currentIndex()))
@@ -157,6 +182,10 @@ class Main(QMainWindow):
             self.cfg.write(f)
         # self.converter_executor.submit(self.converter.convert)
 
+    def cancel_convert(self):
+        # the job started last, whether it's running or still waiting
+        self.msg_sender("[cancel]", self.job_id or "")
+
     def select_file(self):
         fileName, _ = QFileDialog.getOpenFileName(self,"Select a file" if sys_lang == "en" else "选择一个文档",
                                                   "","All Files (*);;Documents (*.txt *.pdf *.doc *.docx *.rtf *.htm *.html);;")
@@ -244,6 +273,9 @@ class Main(QMainWindow):
         self.convert_btn.setEnabled(False)
         self.convert_btn.clicked.connect(self.start_convert)
 
+        self.cancel_btn = QPushButton("Cancel" if sys_lang == "en" else "取消")
+        self.cancel_btn.clicked.connect(self.cancel_convert)
+
         self.result_btn = QPushButton("Open Result" if sys_lang == "en" else "打开结果")
         self.result_btn.setEnabled(False)
         self.result_btn.clicked.connect(self.open_result)
@@ -256,6 +288,7 @@ class Main(QMainWindow):
         group.addWidget(self.save_btn)
         group.addSpacing(100)
         group.addWidget(self.convert_btn)
+        group.addWidget(self.cancel_btn)
         group.addSpacing(100)
         group.addWidget(self.result_btn)
         group.addStretch(1)
@@ -263,7 +296,8 @@ class Main(QMainWindow):
 
     def init_converter(self):
         self.converter_process = Process(target=ConverterController)
-        self.converter_process.daemon = True
+        # not daemonic so the converter can start its own synthesis worker processes, terminate() takes care of it
+        self.converter_process.daemon = False
         self.converter_process.start()
         ctx = zmq.Context()
         self.pub_socket = ctx.socket(zmq.PUB)
@@ -283,6 +317,7 @@ class Main(QMainWindow):
         self.new_input.connect(self.update_text_input)
         self.new_download.connect(self.show_download_dialog)
         self.conversion_status.connect(self.conversion_done)
+        self.job_id = None
 
         from configparser import ConfigParser
         self.cfg = ConfigParser()
@@ -345,6 +380,9 @@ class Main(QMainWindow):
             self.pub_socket.close()
         if self.sub_socket:
             self.sub_socket.close()
+        if self.converter_process and self.converter_process.is_alive():
+            # [exit] stops the synthesis workers, give the converter a moment for that before terminating it
+            self.converter_process.join(timeout=5)
         if self.converter_process and self.converter_process.is_alive():
             self.converter_process.terminate()
             self.converter_process.join(timeout=2)
@@ -1,3 +1,9 @@
+import re
+from functools import lru_cache
+
+from cn_numbers import verbalize_numbers
+
+
 def parse_lrc_time(t):
     m, rem = divmod(t, 60)
     s = int(rem)
@@ -14,11 +20,8 @@ def parse_srt_time(t):
 
 
 def replace_with_cn_num(s):
-    from num2chinese import num2chinese
-    import re
-    def replace_fn(match):
-        return num2chinese(match.group(0))
-    return re.sub(r"[+-]?\d+\.?[\d]*", replace_fn, s)
+    # numbers are read according to their context (years, dates, phone numbers, ranges...), see cn_numbers
+    return verbalize_numbers(s)
 
 
 def cn_sent_tokenize(s):
@@ -33,56 +36,95 @@ def cn_sent_tokenize(s):
     # 很多规则中会考虑分号;，但是这里我把它忽略不计，破折号、英文双引号等同样忽略，需要的再做些简单调整即可。
     return s.split("\n")
 
-def cn_spell_out_unit(s):
-    import re
-
-    def replace_units(match):
-        unit = match.group(2).lower()
-        if unit == "m": unit="米"
-        elif unit == "v": unit="伏"
-        elif unit == "s": unit="秒"
-        elif unit == "h": unit="小时"
-        elif unit == "g": unit="克"
-        elif unit == "w": unit="瓦"
-        elif unit == "a": unit="安"
-        elif unit == "pa": unit="帕"
-        else: return match.group(0)
-
-        return match.group(1) + unit
-
-    s = re.sub(r"([+-]?\d+\.?\d*)([a-z]{1,4})", replace_units, s, flags=re.IGNORECASE)
-
-    s = re.sub("kpa", "千帕", s, flags=re.IGNORECASE)
-    s = re.sub("kg", "千克", s, flags=re.IGNORECASE)
-    s = re.sub("km", "千米", s, flags=re.IGNORECASE)
-    s = re.sub("kw", "千瓦", s, flags=re.IGNORECASE)
-    s = re.sub("kv", "千伏", s, flags=re.IGNORECASE)
-    s = re.sub("cm", "厘米", s, flags=re.IGNORECASE)
-    s = re.sub("mm", "毫米", s, flags=re.IGNORECASE)
-    s = re.sub("mg", "毫克", s, flags=re.IGNORECASE)
-    s = re.sub("ma", "毫安", s, flags=re.IGNORECASE)
-    s = re.sub("mah", "毫安时", s, flags=re.IGNORECASE)
-    s = re.sub("kwh", "千瓦时", s, flags=re.IGNORECASE)
-    s = re.sub("mmhg", "毫米汞柱", s, flags=re.IGNORECASE)
-
-    def replace_yuan(match):
-        return match.group(0)[1:] + "元"
-
-    s = re.sub(r"¥[+-]?\d+\.?\d*", replace_yuan, s, flags=re.IGNORECASE)
-    return s.replace("℃", "摄氏度").replace("¥", "元")
+SEGMENT_CHUNK_SIZE = 1 << 16 # characters of the document tokenized at a time
+_CN_SPLIT_UNSAFE = "。！？?.…”’" # characters the cn_sent_tokenize rules can start or continue a match with
+_CN_SPLIT_MARGIN = 8 # longer than any match of those rules
+_WHITESPACE_RE = re.compile(r"\s+")
+
+def text_chunks(txt, size=SEGMENT_CHUNK_SIZE):
+    for start in range(0, len(txt), size):
+        yield txt[start:start + size]
+
+def iter_sentences(chunks, lang):
+    # yields the same sentences as tokenizing the whole document at once, while only holding a chunk or two of it,
+    # chunks is an iterable of text pieces (e.g. a file read in blocks) or a string
+    if isinstance(chunks, str): chunks = text_chunks(chunks)
+    return _iter_cn_sentences(chunks) if lang == "zh" else _iter_en_sentences(chunks)
+
+def _iter_cn_sentences(chunks):
+    # a split is final once the sentence after it can't be part of a match and enough text follows it,
+    # tokenizing again from that sentence then gives the same result as tokenizing everything
+    buffer = ""
+    for chunk in chunks:
+        buffer += _WHITESPACE_RE.sub("", chunk)
+        sentences = cn_sent_tokenize(buffer)
+        keep, start, cut = 0, 0, 0
+        for k, sentence in enumerate(sentences):
+            if k and sentence[:1] not in _CN_SPLIT_UNSAFE and len(buffer) - start >= _CN_SPLIT_MARGIN:
+                keep, cut = k, start
+            start += len(sentence)
+        yield from sentences[:keep]
+        buffer = buffer[cut:]
+    yield from cn_sent_tokenize(buffer)
+
+def _punkt_tokenizer():
+    # the tokenizer nltk's sent_tokenize uses
+    try:
+        from nltk.tokenize import _get_punkt_tokenizer
+        return _get_punkt_tokenizer("english")
+    except ImportError:
+        import nltk
+        return nltk.data.load("tokenizers/punkt/english.pickle")
+
+def _iter_en_sentences(chunks):
+    # punkt decides on a boundary by looking at the token after it, so the last two sentences are held back
+    # until more text arrives, the last one might not be complete yet
+    tokenizer = _punkt_tokenizer()
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk.replace("\n", " ")
+        spans = list(tokenizer.span_tokenize(buffer))
+        if len(spans) <= 2: continue
+        for start, end in spans[:-2]:
+            yield buffer[start:end]
+        buffer = buffer[spans[-2][0]:]
+    yield from tokenizer.tokenize(buffer)
+
+# normalization tables, built once at import and applied in a single pass over the text
+CN_UNITS = {"m": "米", "v": "伏", "s": "秒", "h": "小时", "g": "克", "w": "瓦", "a": "安", "pa": "帕"}
+# matched leftmost first in this order, so mah, kwh and mmhg are read as ma, kw and mm followed by a letter
+CN_ABBREVIATED_UNITS = {"kpa": "千帕", "kg": "千克", "km": "千米", "kw": "千瓦", "kv": "千伏", "cm": "厘米", "mm": "毫米", "mg": "毫克",
+                        "ma": "毫安", "mah": "毫安时", "kwh": "千瓦时", "mmhg": "毫米汞柱"}
+CN_UNIT_SYMBOLS = {"℃": "摄氏度", "¥": "元"}
+CN_PUNCTUATION = {"、": "，", "：": "，", "；": "，", "．": "，", "“": "", "”": "", "‘": "", "’": "", "（": "，", "）": "，",
+                  "(": "，", ")": "，", "＞": "大于", "＜": "小于", "~": "至"}
+
+# a number directly followed by exactly one unit (the whole run of letters), the unit letters themselves are ASCII only
+_CN_UNIT = r"(?-i:[pP][aA]|[mvshgwaMVSHGWA])(?![a-z])"
+# the lookahead on the first character lets the scan skip most positions without trying every alternative
+_CN_UNIT_RE = re.compile(rf"(?=[¥+\-\d{''.join(sorted(set(u[0] for u in CN_ABBREVIATED_UNITS)))}])"
+                         rf"(?:¥(?P<yuan>[+-]?\d+\.?\d*)(?P<yuan_unit>{_CN_UNIT})?"
+                         rf"|(?P<num>[+-]?\d+\.?\d*)(?P<unit>{_CN_UNIT})"
+                         rf"|(?P<abbr>{'|'.join(CN_ABBREVIATED_UNITS)}))", re.IGNORECASE)
+_CN_PERCENT_RE = re.compile(r"([+-]?\d+\.?\d*)%")
+_CN_UNIT_SYMBOL_TABLE = str.maketrans(CN_UNIT_SYMBOLS)
+_CN_TEXT_TABLE = str.maketrans({**CN_UNIT_SYMBOLS, **CN_PUNCTUATION})
+
+
+def _replace_cn_unit(match):
+    if match.group("abbr"): return CN_ABBREVIATED_UNITS[match.group("abbr").lower()]
+    if match.group("yuan"):
+        unit = match.group("yuan_unit")
+        return match.group("yuan") + "元" + (CN_UNITS[unit.lower()] if unit else "")
+    return match.group("num") + CN_UNITS[match.group("unit").lower()]
 
-def preprocess_cn_text(s):
-    import re
-    def replace_fn(match):
-        return "百分之" + match.group(0)[:-1]
 
-    s = re.sub(r"[+-]?\d+\.?\d*%", replace_fn, s)
-
-    s = cn_spell_out_unit(s)
+def cn_spell_out_unit(s):
+    return _CN_UNIT_RE.sub(_replace_cn_unit, s).translate(_CN_UNIT_SYMBOL_TABLE)
 
-    return s.replace("、", "，").replace("：", "，").replace("；", "，").replace("．", "，").replace("“", '')\
-        .replace("”", '').replace("‘", "").replace("’", "").replace("（", "，").replace("）", "，")\
-        .replace("(", "，").replace(")", "，").replace("＞", "大于").replace("＜", "小于").replace("~", "至")
+def preprocess_cn_text(s):
+    if "%" in s: s = _CN_PERCENT_RE.sub(r"百分之\1", s)
+    return _CN_UNIT_RE.sub(_replace_cn_unit, s).translate(_CN_TEXT_TABLE)
 
 def get_full_esp_model_tag(tag, lang):
     if lang == "en":
@@ -104,10 +146,92 @@ def get_full_vocoder_model_tag(tag, lang):
             version = "v2"
     return corpus + "_" + tag + "." + version
 
+_HAN_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+_LATIN_RE = re.compile(r"[A-Za-z]")
+
+@lru_cache(maxsize=4096)
+def detect_segment_language(s):
+    # "zh", "en" or None for text without letters, text in only one script is decided without running langdetect
+    han, latin = len(_HAN_RE.findall(s)), len(_LATIN_RE.findall(s))
+    if not han and not latin: return None
+    if not latin: return "zh"
+    if not han: return "en"
+    from langdetect import detect, DetectorFactory
+    from langdetect.lang_detect_exception import LangDetectException
+    DetectorFactory.seed = 0 # enforcing consistent output
+    try:
+        lang = detect(s)
+    except LangDetectException:
+        lang = ""
+    if "zh" in lang: return "zh"
+    if lang == "en": return "en"
+    return "zh" if han * 5 >= latin else "en" # about five letters per English word for every Chinese character
+
 def uncircle(s):
     for i in range(1, 21):
         s = s.replace(chr(0x245f + i), str(i))
     return s.replace('\u24ea', '0')
 
 def general_preprocess(txt):
-    return uncircle(txt)
\ No newline at end of file
+    return uncircle(txt)
+
+def group_sentences(sentences, batch_size, max_len_ratio=2.0):
+    # group consecutive sentences into batches of similar length, so short sentences don't get padded to long ones,
+    # batches are yielded as soon as they're complete
+    batch = []
+    for s in sentences:
+        l = max(len(s[-1]), 1)
+        if batch:
+            first = max(len(batch[0][-1]), 1)
+            if len(batch) >= batch_size or l > first * max_len_ratio or l * max_len_ratio < first:
+                yield batch
+                batch = []
+        batch.append(s)
+    if batch: yield batch
+
+
+def peak_rss():
+    # peak resident memory of this process in bytes, None where the resource module isn't available (Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    import sys
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+SECONDARY_PUNCTUATION = "，；、：,;:"
+
+def split_long_sentence(s, target_len):
+    # split after secondary punctuation, then pack the pieces back together up to target_len
+    pieces, start = [], 0
+    for j, ch in enumerate(s):
+        if ch in SECONDARY_PUNCTUATION:
+            pieces.append(s[start:j + 1])
+            start = j + 1
+    if start < len(s): pieces.append(s[start:])
+    chunks = []
+    for piece in pieces:
+        if chunks and len(chunks[-1]) + len(piece) <= target_len: chunks[-1] += piece
+        else: chunks.append(piece)
+    return chunks
+
+def resegment(sentences, target_len, joiner=""):
+    # merges short neighbouring sentences and splits overlong ones towards target_len characters,
+    # yields (text, first, last) units where first and last are the (inclusive) indices of the source sentences,
+    # each one as soon as the next sentence shows it can't grow any more
+    unit = None
+    for idx, s in enumerate(sentences):
+        if len(s) > target_len * 1.5:
+            if unit: yield tuple(unit)
+            unit = None
+            for piece in split_long_sentence(s, target_len):
+                piece = piece.strip()
+                if piece: yield piece, idx, idx
+        elif unit and len(unit[0]) + len(joiner) + len(s) <= target_len:
+            unit[0] += joiner + s if unit[0] else s
+            unit[2] = idx
+        else:
+            if unit: yield tuple(unit)
+            unit = [s, idx, idx]
+    if unit: yield tuple(unit)
@@ -0,0 +1,63 @@
+import os
+import struct
+import threading
+
+HEADER_SIZE = 44
+SAMPLE_WIDTH = 2  # 16 bit PCM, same as soundfile's default for WAV
+
+
+def wav_header(sample_rate, data_size):
+    return b"RIFF" + struct.pack("<I", min(data_size + HEADER_SIZE - 8, 0xFFFFFFFF)) + b"WAVE" \
+        + b"fmt " + struct.pack("<IHHIIHH", 16, 1, 1, sample_rate, sample_rate * SAMPLE_WIDTH, SAMPLE_WIDTH, SAMPLE_WIDTH * 8) \
+        + b"data" + struct.pack("<I", min(data_size, 0xFFFFFFFF - HEADER_SIZE))
+
+
+def to_pcm(wav):
+    import numpy as np
+    if hasattr(wav, "cpu"): wav = wav.view(-1).cpu().numpy()
+    if wav.dtype == np.int16: return wav  # already PCM, e.g. copied from a previous output
+    return (np.clip(wav, -1.0, 1.0) * 0x7FFF).round().astype("<i2")
+
+
+class WavWriter:
+    # keeps one handle open for the whole job and writes raw PCM, the header is fixed up once in close().
+    # until then the header claims the maximum size, so players opening the file early read up to the end of it
+    def __init__(self, fname, sample_rate, resume_samples=0):
+        # resume_samples keeps that many samples of an existing file and continues writing after them
+        self.fname = fname
+        self.sample_rate = sample_rate
+        self.samples = resume_samples
+        self.lock = threading.Lock()
+        self.f = open(fname, "r+b" if resume_samples else "w+b")
+        self.f.truncate(HEADER_SIZE + resume_samples * SAMPLE_WIDTH)
+        self.f.seek(0)
+        self.f.write(wav_header(sample_rate, 0xFFFFFFFF))
+
+    @staticmethod
+    def data_samples(fname):
+        # samples in an existing file, including ones written before a crash left the header unfinished
+        try:
+            return max(0, (os.path.getsize(fname) - HEADER_SIZE) // SAMPLE_WIDTH)
+        except OSError:
+            return 0
+
+    def write(self, wav):
+        pcm = to_pcm(wav)
+        with self.lock:
+            self.f.seek(HEADER_SIZE + self.samples * SAMPLE_WIDTH)
+            self.f.write(pcm.tobytes())
+            self.samples += len(pcm)
+
+    def flush(self):
+        # makes everything written so far durable
+        with self.lock:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        with self.lock:
+            if self.f.closed: return
+            self.f.truncate(HEADER_SIZE + self.samples * SAMPLE_WIDTH)
+            self.f.seek(0)
+            self.f.write(wav_header(self.sample_rate, self.samples * SAMPLE_WIDTH))
+            self.f.close()